@@ -14,6 +14,7 @@ import os
 from pathlib import Path
 import sys
 
+from celery.schedules import crontab
 from dotenv import load_dotenv
 from loguru import logger
 import sentry_sdk
@@ -45,6 +46,7 @@ INSTALLED_APPS = [
     "django.contrib.sessions",
     "django.contrib.messages",
     "django.contrib.staticfiles",
+    "django.contrib.postgres",
 
     "core",
 
@@ -57,6 +59,7 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
+    "core.middleware.CompressionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
@@ -139,7 +142,16 @@ STATIC_ROOT = "static"
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 REST_FRAMEWORK = {
-    'DEFAULT_FILTER_BACKENDS': ['django_filters.rest_framework.DjangoFilterBackend']
+    'DEFAULT_FILTER_BACKENDS': ['django_filters.rest_framework.DjangoFilterBackend'],
+    'DEFAULT_RENDERER_CLASSES': [
+        'core.renderers.ORJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'core.renderers.ORJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
 }
 
 # AMQP
@@ -150,14 +162,99 @@ AMQP_URL = "amqp://{user}:{password}@{host}:{port}/".format(
     port=os.getenv("RABBITMQ_PORT", "5672"),
 )
 
+# How long an account may stay checked out (SENT) or queued (IN_QUEUE)
+# before it is returned to the pool, in seconds. A checkout is leased for
+# CHECKOUT_LEASE, longer than any parsing session: workers that do not call
+# the lease endpoint must not lose the account mid-session. Each call to it
+# extends the lease by CREDENTIALS_LEASE from then on.
+CHECKOUT_LEASE = int(os.getenv("CHECKOUT_LEASE", 60 * 60 * 24))
+CREDENTIALS_LEASE = int(os.getenv("CREDENTIALS_LEASE", 60 * 60 * 2))
+QUEUE_LEASE = int(os.getenv("QUEUE_LEASE", 60 * 60 * 6))
+# Accounts published or checked out this recently are left alone by the
+# queue reconciliation, in seconds
+RECONCILE_GRACE = int(os.getenv("RECONCILE_GRACE", 60 * 2))
+# Waiting accounts are released by delayed messages, the fallback sweep only
+# picks up those still waiting this long after their wait ended, in seconds
+RELEASE_GRACE = int(os.getenv("RELEASE_GRACE", 60 * 15))
+
+# Dynamic limits planner: history window in days, share of the smallest
+# request count an account was banned at, and growth over the best clean
+# session for accounts that were not banned
+LIMITS_WINDOW = int(os.getenv("LIMITS_WINDOW", 7))
+LIMITS_SAFETY = float(os.getenv("LIMITS_SAFETY", 0.8))
+LIMITS_GROWTH = float(os.getenv("LIMITS_GROWTH", 1.25))
+
+# Proxy health check: "ip_echo" fetches PROXY_CHECK_URL through the proxy
+# and compares the exit ip, "tcp" only connects to the proxy and "socks"
+# also completes the SOCKS5 handshake. Timeouts are in seconds.
+PROXY_CHECK_METHOD = os.getenv("PROXY_CHECK_METHOD", "ip_echo")
+PROXY_CHECK_URL = os.getenv("PROXY_CHECK_URL", "https://api.ipify.org/")
+PROXY_CHECK_CONNECT_TIMEOUT = float(os.getenv("PROXY_CHECK_CONNECT_TIMEOUT", 5))
+PROXY_CHECK_TIMEOUT = float(os.getenv("PROXY_CHECK_TIMEOUT", 15))
+
+# Proxy check history kept for the latency summary, in days, and the
+# success rate below which a proxy is picked last
+PROXY_CHECK_WINDOW = int(os.getenv("PROXY_CHECK_WINDOW", 7))
+PROXY_MIN_SUCCESS_RATE = float(os.getenv("PROXY_MIN_SUCCESS_RATE", 0.8))
+
+# Proxy circuit breaker: the proxy is disabled when this many accounts
+# report a proxy error within the window, rechecked after the delay and
+# kept on probation for CIRCUIT_HALF_OPEN seconds once it recovers
+CIRCUIT_WINDOW = int(os.getenv("CIRCUIT_WINDOW", 60 * 5))
+CIRCUIT_THRESHOLD = int(os.getenv("CIRCUIT_THRESHOLD", 3))
+CIRCUIT_RECHECK_DELAY = int(os.getenv("CIRCUIT_RECHECK_DELAY", 60))
+CIRCUIT_HALF_OPEN = int(os.getenv("CIRCUIT_HALF_OPEN", 60 * 10))
+
+# Rebalancer: how many live accounts of one network a proxy may hold
+REBALANCE_PROXY_CAP = int(os.getenv("REBALANCE_PROXY_CAP", 10))
+
+# Statistics analytics report, written by build_statistics_report. Kept
+# out of the source tree, docker-compose shares the directory between web
+# and the sweeps worker through the analytics volume.
+ANALYTICS_DAYS = int(os.getenv("ANALYTICS_DAYS", 30))
+ANALYTICS_REPORT_PATH = os.getenv(
+    "ANALYTICS_REPORT_PATH",
+    "/var/lib/credentials_manager/analytics/statistics.json",
+)
+
+# Telegram
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org")
+TELEGRAM_API_TOKEN = os.getenv("TELEGRAM_API_TOKEN")
+TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
+TELEGRAM_TIMEOUT = 10
+
 # Celery
 CELERY_BROKER_URL = AMQP_URL
 CELERY_TIMEZONE = TIME_ZONE
 
+# hot: per-account status changes on the checkout path, prefork.
+# sweeps: periodic database-bound batches, prefork with prefetch 1.
+# io: tasks waiting on proxies and outside services, threads pool.
+# See the celery_* services in docker-compose.yaml.
+CELERY_TASK_ROUTES = {
+    "core.tasks.record_checkout": {"queue": "hot"},
+    "core.tasks.publish_account": {"queue": "hot"},
+    "core.tasks.schedule_account_release": {"queue": "hot"},
+    "core.tasks.release_account": {"queue": "hot"},
+    "close_circuit": {"queue": "hot"},
+    "load_accounts_to_queue": {"queue": "sweeps"},
+    "load_ok_accounts_to_queue": {"queue": "sweeps"},
+    "update_credentials_proxy_statuses": {"queue": "sweeps"},
+    "reclaim_expired_leases": {"queue": "sweeps"},
+    "reconcile_queues": {"queue": "sweeps"},
+    "check_proxy_rents": {"queue": "sweeps"},
+    "plan_limits": {"queue": "sweeps"},
+    "rebalance_accounts": {"queue": "sweeps"},
+    "build_statistics_report": {"queue": "sweeps"},
+    "update_proxy_statuses": {"queue": "io"},
+    "recheck_proxy": {"queue": "io"},
+    "send_notifications": {"queue": "io"},
+}
+
 CELERYBEAT_SCHEDULE = {
     "update_credentials_proxy_statuses": {
         "task": "update_credentials_proxy_statuses",
-        "schedule": 60 * 5,
+        "schedule": 60 * 60,  # fallback for lost release messages
     },
     "update_proxy_statuses": {
         "task": "update_proxy_statuses",
@@ -171,6 +268,34 @@ CELERYBEAT_SCHEDULE = {
         "task": "load_ok_accounts_to_queue",
         "schedule": 60 * 10,  # run every 10 min
     },
+    "reclaim_expired_leases": {
+        "task": "reclaim_expired_leases",
+        "schedule": 60 * 5,
+    },
+    "reconcile_queues": {
+        "task": "reconcile_queues",
+        "schedule": 60 * 5,
+    },
+    "check_proxy_rents": {
+        "task": "check_proxy_rents",
+        "schedule": crontab(hour=9, minute=0),
+    },
+    "send_notifications": {
+        "task": "send_notifications",
+        "schedule": 60 * 1,
+    },
+    "plan_limits": {
+        "task": "plan_limits",
+        "schedule": 60 * 60,
+    },
+    "rebalance_accounts": {
+        "task": "rebalance_accounts",
+        "schedule": 60 * 60 * 6,
+    },
+    "build_statistics_report": {
+        "task": "build_statistics_report",
+        "schedule": crontab(hour=4, minute=0),
+    },
 }
 
 # Logging
@@ -22,13 +22,16 @@ from drf_yasg.views import get_schema_view
 from rest_framework import permissions
 
 from core.views import (
+    CredentialsProxyLeaseView,
     CredentialsProxyUpdateView,
     CredentialsProxyView,
     CredentialsStatisticsListView,
     LimitsView,
     CredentialsProxyListView,
+    MetricListView,
     ProxyListView,
     ProxyView,
+    StatisticsUsageView,
 )
 
 schema_view = get_schema_view(
@@ -45,11 +48,14 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     path('docs/', schema_view.with_ui('swagger', cache_timeout=0), name='schema-swagger-ui'),
     path('api/credentials/<int:pk>', CredentialsProxyUpdateView.as_view()),
+    path('api/credentials/<int:pk>/lease', CredentialsProxyLeaseView.as_view()),
     path('api/credentials/<str:network>', CredentialsProxyView.as_view()),
     path('api/credentials/', CredentialsProxyListView.as_view()),
     path('api/proxy/', ProxyListView.as_view()),
     path('api/proxy/<str:network>', ProxyView.as_view()),
     path('api/statistics/', CredentialsStatisticsListView.as_view()),
+    path('api/statistics/usage/<str:network>', StatisticsUsageView.as_view()),
     path('api/limits/<str:network>', LimitsView.as_view()),
+    path('api/metrics/', MetricListView.as_view()),
     re_path(r'^static/(?P<path>.*)$', serve, {'document_root': settings.STATIC_ROOT}),
 ]
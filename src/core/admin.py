@@ -5,15 +5,18 @@ import json
 import uuid
 
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
 from django.db import IntegrityError
+from django.forms.models import BaseInlineFormSet
 from django.http import HttpResponse
 from django.shortcuts import redirect, render
 from django.urls import path
 from django.utils import timezone
 
-from core import tasks
+from core import analytics, signals, tasks
 from core.forms import CsvImportForm
-from core.models import (Credentials, CredentialsProxy, CredentialsStatistics, Network, ParsingType, Proxy, ProxyRent)
+from core.paginator import EstimatedCountPaginator
+from core.models import (Credentials, CredentialsCookies, CredentialsProxy, CredentialsStatistics, Metric, Network, Notification, ParsingType, Proxy, ProxyRent)
 
 
 def get_date(date):
@@ -33,8 +36,51 @@ class ReadOnlyMixin:
         return False
 
 
+class OnlyChangeList(ChangeList):
+    def get_queryset(self, request):
+        return super().get_queryset(request).only(*self.model_admin.list_only)
+
+
+class ListOnlyMixin:
+    # Columns loaded by the changelist, wide ones left out. The change page
+    # still loads the whole row.
+    list_only = ()
+
+    def get_changelist(self, request, **kwargs):
+        return OnlyChangeList
+
+
+class LatestInlineFormSet(BaseInlineFormSet):
+    limit = 20
+
+    def get_queryset(self):
+        if not hasattr(self, '_latest_queryset'):
+            queryset = super().get_queryset()
+            self._latest_queryset = queryset.filter(
+                pk__in=queryset.values('pk')[:self.limit]
+            )
+        return self._latest_queryset
+
+
 class CredentialsStatisticsInline(ReadOnlyMixin, admin.TabularInline):
     model = CredentialsStatistics
+    formset = LatestInlineFormSet
+    ordering = ['-end_time_of_use']
+    fields = (
+        'start_time_of_use',
+        'end_time_of_use',
+        'request_count',
+        'limit',
+        'result_status',
+        'status_description',
+        'proxy',
+    )
+    verbose_name_plural = (
+        f"статистика по аккаунтам (последние {LatestInlineFormSet.limit})"
+    )
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('proxy')
 
 
 class ProxyRentInline(ReadOnlyMixin, admin.TabularInline):
@@ -120,6 +166,8 @@ class ProxyAdmin(admin.ModelAdmin):
         '__str__',
         'status',
         'status_updated',
+        'circuit',
+        'expiration_date',
         'mobile',
         'enable',
     )
@@ -129,12 +177,28 @@ class ProxyAdmin(admin.ModelAdmin):
     )
 
     search_fields = ['ip']
-    list_filter = ['status']
+    list_filter = ['status', 'circuit']
 
     actions = ['export_as_csv']
 
     inlines = [ProxyRentInline]
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).with_latest_rent()
+
+    def save_model(self, request, obj, form, change):
+        # A manual change of enable is kept when the circuit half opens
+        if "enable" in form.changed_data:
+            obj.circuit_disabled = False
+        super().save_model(request, obj, form, change)
+
+    @admin.display(
+        description="Окончание аренды",
+        ordering="latest_rent_expiration_date",
+    )
+    def expiration_date(self, obj):
+        return obj.latest_rent_expiration_date
+
     def get_urls(self):
         urls = super().get_urls()
         return [
@@ -159,13 +223,10 @@ class ProxyAdmin(admin.ModelAdmin):
             'expiration_date',
             'price',
         ])
-        for obj in queryset:
-            last_rent = obj.rents.last()
+        for obj in queryset.with_latest_rent():
             date = None
-            price = None
-            if last_rent:
-                date = last_rent.expiration_date.strftime("%d.%m.%Y")
-                price = last_rent.price
+            if obj.latest_rent_expiration_date:
+                date = obj.latest_rent_expiration_date.strftime("%d.%m.%Y")
 
             writer.writerow([
                 obj.login,
@@ -175,7 +236,7 @@ class ProxyAdmin(admin.ModelAdmin):
                 obj.type,
                 str(obj.mobile).lower(),
                 date,
-                price,
+                obj.latest_rent_price,
             ])
 
         return response
@@ -227,7 +288,7 @@ class ProxyAdmin(admin.ModelAdmin):
 
 
 @admin.register(CredentialsProxy)
-class CredentialsProxyAdmin(admin.ModelAdmin):
+class CredentialsProxyAdmin(ListOnlyMixin, admin.ModelAdmin):
     change_list_template = "entities/credentials_proxy_changelist.html"
 
     list_display = (
@@ -239,6 +300,18 @@ class CredentialsProxyAdmin(admin.ModelAdmin):
         'start_time_of_use',
         'enable',
     )
+    list_select_related = ('credentials__network', 'proxy')
+    list_only = (
+        'credentials__login',
+        'credentials__network__title',
+        'proxy__ip',
+        'proxy__port',
+        'status',
+        'status_updated',
+        'waiting_delta',
+        'start_time_of_use',
+        'enable',
+    )
 
     list_editable = ('enable', 'status')
 
@@ -249,11 +322,13 @@ class CredentialsProxyAdmin(admin.ModelAdmin):
         'status_updated',
         'waiting_delta',
         'start_time_of_use',
+        'lease_expires_at',
         'cookies',
     ]
 
     search_fields = ['credentials__login', 'proxy__ip']
     list_filter = ['credentials__network', 'status']
+    show_full_result_count = False
 
     inlines = [CredentialsStatisticsInline]
 
@@ -261,10 +336,16 @@ class CredentialsProxyAdmin(admin.ModelAdmin):
 
     @admin.action(description="Поменять статус на «Available»")
     def make_available(self, request, queryset):
-        updated = queryset.update(
+        credentials_proxy_ids = list(queryset.values_list("id", flat=True))
+        updated = CredentialsProxy.objects.filter(
+            id__in=credentials_proxy_ids
+        ).update(
             status=CredentialsProxy.Status.AVAILABLE,
             status_updated=timezone.now(),
+            lease_expires_at=None,
+            circuit_parked=False,
         )
+        signals.publish_on_commit(credentials_proxy_ids)
         self.message_user(request, f"{updated} аккаунтов были изменены")
 
     @admin.action(description="Выгрузить в csv")
@@ -287,15 +368,12 @@ class CredentialsProxyAdmin(admin.ModelAdmin):
             'proxy_price',
             'cookies',
         ])
-        for obj in queryset:
+        for obj in queryset.select_related(
+            "credentials__network", "proxy", "cookie_jar"
+        ).with_latest_rent():
             date = None
-            price = None
-            proxy = obj.proxy
-            if proxy:
-                last_rent = proxy.rents.last()
-                if last_rent:
-                    date = last_rent.expiration_date.strftime("%d.%m.%Y")
-                    price = last_rent.price
+            if obj.latest_rent_expiration_date:
+                date = obj.latest_rent_expiration_date.strftime("%d.%m.%Y")
 
             writer.writerow([
                 obj.credentials.network.title,
@@ -308,7 +386,7 @@ class CredentialsProxyAdmin(admin.ModelAdmin):
                 obj.proxy.port,
                 obj.proxy.type,
                 date,
-                price,
+                obj.latest_rent_price,
                 json.dumps(obj.cookies),
             ])
 
@@ -372,16 +450,16 @@ class CredentialsProxyAdmin(admin.ModelAdmin):
                         if cookies is not None and isinstance(cookies, str):
                             cookies = json.loads(cookies)
 
-                        CredentialsProxy.objects.update_or_create(
+                        credentials_proxy_obj, _ = CredentialsProxy.objects.update_or_create(
                             credentials=credentials,
                             defaults={
                                 "proxy": proxy,
                                 "status": CredentialsProxy.Status.AVAILABLE,
                                 "enable": True,
-                                "cookies": cookies,
                                 "token": credentials_proxy.get("token"),
                             }
                         )
+                        CredentialsCookies.store(credentials_proxy_obj.id, cookies)
                     except IntegrityError:
                         pass
 
@@ -396,7 +474,9 @@ class CredentialsProxyAdmin(admin.ModelAdmin):
 
 
 @admin.register(CredentialsStatistics)
-class CredentialsStatisticsAdmin(ReadOnlyMixin, admin.ModelAdmin):
+class CredentialsStatisticsAdmin(ReadOnlyMixin, ListOnlyMixin, admin.ModelAdmin):
+    change_list_template = "entities/statistics_changelist.html"
+
     list_display = (
         'account_title',
         'start_time_of_use',
@@ -406,6 +486,39 @@ class CredentialsStatisticsAdmin(ReadOnlyMixin, admin.ModelAdmin):
         'result_status',
         'proxy',
     )
+    list_select_related = ('proxy',)
+    list_only = (
+        'account_title',
+        'start_time_of_use',
+        'end_time_of_use',
+        'request_count',
+        'limit',
+        'result_status',
+        'proxy__ip',
+        'proxy__port',
+    )
+    list_filter = ['result_status']
+    ordering = ['-end_time_of_use']
+    raw_id_fields = ['credentials_proxy', 'proxy']
+
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_urls(self):
+        urls = super().get_urls()
+        return [
+            path('analytics/', self.admin_site.admin_view(self.analytics)),
+            *urls,
+        ]
+
+    def analytics(self, request):
+        report = analytics.read_report()
+        total = [{"label": "Все сети", **report["total"]}] if report else []
+        return render(
+            request,
+            "admin/statistics_analytics.html",
+            {"report": report, "total": total},
+        )
 
 
 class ParsingTypeInline(admin.TabularInline):
@@ -415,3 +528,15 @@ class ParsingTypeInline(admin.TabularInline):
 @admin.register(Network)
 class NetworkAdmin(admin.ModelAdmin):
     inlines = [ParsingTypeInline]
+
+
+@admin.register(Metric)
+class MetricAdmin(ReadOnlyMixin, admin.ModelAdmin):
+    list_display = ('name', 'period', 'value')
+    list_filter = ['name']
+
+
+@admin.register(Notification)
+class NotificationAdmin(ReadOnlyMixin, admin.ModelAdmin):
+    list_display = ('__str__', 'created', 'sent', 'attempts', 'next_attempt')
+    list_filter = ['kind']
@@ -1,39 +1,224 @@
+from itertools import count
 from typing import Union
+import zlib
 
 from django.conf import settings
 from kombu import Connection, Exchange, Queue
+from kombu.mixins import ConsumerMixin
+from kombu.pools import producers
+from loguru import logger
 
+ACCOUNTS_EXCHANGE = Exchange("accounts", "direct", durable=True)
+MAX_PRIORITY = 9
 
-def publish(queue_name, account: Union[dict, list]):
-    with Connection(settings.AMQP_URL) as connection:
-        queue = Queue(
-            name=queue_name,
-            exchange=Exchange("accounts", "direct", durable=True),
-            routing_key=queue_name,
+# Message codecs, announced to consumers through the content-type and
+# compression headers, so a queue may hold messages of mixed codecs.
+CODECS = {
+    "json": {"serializer": "json"},
+    "msgpack": {"serializer": "msgpack"},
+    "msgpack+zstd": {"serializer": "msgpack", "compression": "zstd"},
+}
+ACCEPT = ["json", "msgpack"]
+
+RELEASE_EXCHANGE = Exchange("accounts.release", "direct", durable=True)
+RELEASE_QUEUE = Queue(
+    name="accounts.release",
+    exchange=RELEASE_EXCHANGE,
+    routing_key="release",
+)
+
+
+def get_queue(queue_name, priority=False, shard=None):
+    if shard is not None:
+        queue_name = f"{queue_name}.{shard}"
+    # x-max-priority can't be added to an existing queue, so priority
+    # delivery uses a queue of its own next to the plain FIFO one.
+    if priority:
+        return Queue(
+            name=f"{queue_name}.priority",
+            exchange=ACCOUNTS_EXCHANGE,
+            routing_key=f"{queue_name}.priority",
+            max_priority=MAX_PRIORITY,
         )
-        connection.Producer(serializer="json").publish(
+    return Queue(
+        name=queue_name,
+        exchange=ACCOUNTS_EXCHANGE,
+        routing_key=queue_name,
+    )
+
+
+def get_shard(key, shards):
+    # A network with a single shard keeps its original, unsuffixed queue
+    if shards <= 1:
+        return None
+    if isinstance(key, int):
+        return key % shards
+    return zlib.crc32(str(key).encode()) % shards
+
+
+# Per process, so checkouts spread their first pick over the shards
+shard_counter = count()
+
+
+def get_checkout_queues(queue_name, shards=1, priority=False):
+    if shards <= 1:
+        shard_order = [None]
+    else:
+        start = next(shard_counter) % shards
+        shard_order = [(start + i) % shards for i in range(shards)]
+
+    queues = []
+    for shard in shard_order:
+        if priority:
+            queues.append(get_queue(queue_name, True, shard))
+        queues.append(get_queue(queue_name, False, shard))
+    return queues
+
+
+def make_headers(account_ids, published_at, publish_token, priority=None):
+    return {
+        "account_ids": account_ids,
+        "published_at": published_at.timestamp() if published_at else None,
+        "publish_token": str(publish_token) if publish_token else None,
+        "priority": priority,
+    }
+
+
+def publish(
+    queue_name,
+    account: Union[dict, list],
+    priority=None,
+    codec="json",
+    shard=None,
+    headers=None,
+):
+    queue = get_queue(queue_name, priority is not None, shard)
+    connection = Connection(settings.AMQP_URL)
+    with producers[connection].acquire(block=True) as producer:
+        producer.publish(
             body=account,
+            **CODECS[codec],
             exchange=queue.exchange,
             routing_key=queue.routing_key,
             declare=[queue],
+            priority=priority,
+            headers=headers,
+            retry=True,
             timeout=60,
         )
 
 
-def consume(queue_name, ack=True):
+def inspect_queue(queue):
+    # Message count and the head message's headers, without draining: the
+    # head is rejected back and RabbitMQ returns it to its place.
     with Connection(settings.AMQP_URL) as connection:
-        q = connection.SimpleQueue(Queue(
-            name=queue_name,
-            exchange=Exchange("accounts", "direct", durable=True),
-            routing_key=queue_name,
-        ))
+        try:
+            _, message_count, _ = queue(
+                connection.channel()
+            ).queue_declare(passive=True)
+        except connection.channel_errors:
+            # Not declared yet, nothing was ever published to it
+            return 0, None
+        if not message_count:
+            return 0, None
+
+        q = connection.SimpleQueue(queue, accept=ACCEPT)
         try:
             msg = q.get(block=False)
         except q.Empty:
-            return None
+            return 0, None
+        msg.requeue()
+        return message_count, msg.headers
+
+
+def consume_first(queues, ack=True, check=None):
+    # Takes the first message from the queues, in order, over one connection.
+    # check(headers, payload) returns the payload to hand out, or None to
+    # drop the message and take the next one.
+    with Connection(settings.AMQP_URL) as connection:
+        for queue in queues:
+            q = connection.SimpleQueue(queue, accept=ACCEPT)
+            while True:
+                try:
+                    msg = q.get(block=False)
+                except q.Empty:
+                    break
+
+                payload = msg.payload
+                if check is not None:
+                    payload = check(msg.headers or {}, payload)
+                    if payload is None:
+                        msg.ack()
+                        continue
+                if ack:
+                    msg.ack()
+                    return payload
+                else:
+                    return msg
+        return None
+
+
+def get_delay_bucket(delay):
+    # Delays are rounded down to a power of two to keep the number of delay
+    # queues bounded, release_account schedules the rest of the wait again.
+    return 1 << (max(int(delay), 1).bit_length() - 1)
+
+
+def get_delay_queue(delay):
+    # One queue per bucket: RabbitMQ only expires messages at the head of a
+    # queue, so mixing TTLs in one queue would hold short waits behind long.
+    name = f"accounts.release.delay.{delay}"
+    return Queue(
+        name=name,
+        exchange=Exchange("accounts.release.delay", "direct", durable=True),
+        routing_key=name,
+        message_ttl=delay,
+        expires=delay * 2 + 60,
+        queue_arguments={
+            "x-dead-letter-exchange": RELEASE_EXCHANGE.name,
+            "x-dead-letter-routing-key": RELEASE_QUEUE.routing_key,
+        },
+    )
+
+
+def publish_delayed(delay, body: dict):
+    delay = get_delay_bucket(delay)
+    with Connection(settings.AMQP_URL) as connection:
+        queue = get_delay_queue(delay)
+        connection.Producer(serializer="json").publish(
+            body=body,
+            exchange=queue.exchange,
+            routing_key=queue.routing_key,
+            declare=[RELEASE_QUEUE, queue],
+            expiration=delay,
+            timeout=60,
+        )
+    return delay
+
+
+class ReleaseConsumer(ConsumerMixin):
+    def __init__(self, connection, callback):
+        self.connection = connection
+        self.callback = callback
+
+    def get_consumers(self, Consumer, channel):
+        return [Consumer(
+            queues=[RELEASE_QUEUE],
+            callbacks=[self.on_message],
+            accept=["json"],
+            prefetch_count=100,
+        )]
+
+    def on_message(self, body, message):
+        try:
+            self.callback(**body)
+        except Exception as e:
+            logger.warning(f"Release message {body} was dropped: {e}")
+            message.reject()
         else:
-            if ack:
-                msg.ack()
-                return msg.payload
-            else:
-                return msg
+            message.ack()
+
+
+def consume_releases(callback):
+    with Connection(settings.AMQP_URL) as connection:
+        ReleaseConsumer(connection, callback).run()
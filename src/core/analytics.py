@@ -0,0 +1,234 @@
+from datetime import timedelta
+from itertools import islice
+import os
+
+from django.conf import settings
+from django.db.models import OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+import numpy as np
+import orjson
+
+from core.models import (
+    CredentialsStatistics,
+    CredentialsStatisticsRequest,
+    Network,
+    Proxy,
+)
+
+CHUNK_SIZE = 10000
+
+BAN_STATUSES = (
+    CredentialsStatistics.Status.BANNED,
+    CredentialsStatistics.Status.TEMPORARILY_BANNED,
+)
+
+# Lower bounds of the request count buckets used for the ban hazard
+BUCKETS = np.array([0, 10, 25, 50, 100, 200, 500, 1000, 2000])
+
+# Proxies with fewer sessions are left out of the comparison
+MIN_PROXY_SESSIONS = 10
+
+
+def load_sessions(since):
+    requests = CredentialsStatisticsRequest.objects.filter(
+        statistics=OuterRef("pk")
+    ).values("statistics").annotate(total=Sum("requests")).values("total")
+
+    # Ordered by account and time, see get_lifetimes
+    rows = CredentialsStatistics.objects.filter(
+        end_time_of_use__gte=since
+    ).annotate(
+        requests_total=Coalesce(Subquery(requests), 0),
+    ).order_by(
+        "credentials_proxy_id", "end_time_of_use", "id"
+    ).values_list(
+        "credentials_proxy_id",
+        "proxy_id",
+        "credentials_proxy__credentials__network_id",
+        "requests_total",
+        "result_status",
+    ).iterator(chunk_size=CHUNK_SIZE)
+
+    accounts, proxies, networks, requests, banned = [], [], [], [], []
+    while chunk := list(islice(rows, CHUNK_SIZE)):
+        account_ids, proxy_ids, network_ids, totals, statuses = zip(*chunk)
+        accounts.append(np.fromiter((i or 0 for i in account_ids), np.int64, len(chunk)))
+        proxies.append(np.fromiter((i or 0 for i in proxy_ids), np.int64, len(chunk)))
+        networks.append(np.fromiter((i or 0 for i in network_ids), np.int64, len(chunk)))
+        requests.append(np.fromiter(totals, np.int64, len(chunk)))
+        banned.append(np.fromiter((s in BAN_STATUSES for s in statuses), bool, len(chunk)))
+
+    if not proxies:
+        empty = np.array([], np.int64)
+        return empty, empty, empty, empty, np.array([], bool)
+
+    return (
+        np.concatenate(accounts),
+        np.concatenate(proxies),
+        np.concatenate(networks),
+        np.concatenate(requests),
+        np.concatenate(banned),
+    )
+
+
+def get_lifetimes(accounts, requests, banned):
+    # An account yields requests over its sessions until it is banned, so
+    # requests add up per account up to and including the banning session.
+    # Sessions after a (temporary) ban start a new lifetime. The lifetime
+    # still open at the end of the window is censored: the account was not
+    # banned yet. Sessions of deleted accounts (0) count on their own.
+    if not accounts.size:
+        return np.array([], np.int64), np.array([], bool)
+
+    starts = np.ones(accounts.size, bool)
+    starts[1:] = (accounts[1:] != accounts[:-1]) | banned[:-1] | (accounts[1:] == 0)
+    lifetime = starts.cumsum() - 1
+    totals = np.bincount(lifetime, weights=requests).astype(np.int64)
+    ended = np.zeros(totals.size, bool)
+    ended[lifetime[banned]] = True
+    return totals, ended
+
+
+def get_yield(accounts, requests, banned):
+    totals, ended = get_lifetimes(accounts, requests, banned)
+    if not totals.size:
+        return None
+
+    # Kaplan-Meier estimate of the share of accounts still not banned after
+    # a number of requests. At equal totals bans go before censored ones.
+    order = np.lexsort((~ended, totals))
+    totals, ended = totals[order], ended[order]
+    survival = np.cumprod(1 - ended / np.arange(totals.size, 0, -1))
+
+    def get_percentile(share):
+        reached = np.flatnonzero(survival <= 1 - share + 1e-9)
+        return float(totals[reached[0]]) if reached.size else None
+
+    # Restricted to the largest observed total when it is censored
+    steps = np.diff(totals, prepend=0) * np.concatenate(([1.0], survival[:-1]))
+    return {
+        "accounts": int(totals.size),
+        "censored": int((~ended).sum()),
+        "mean": round(float(steps.sum()), 1),
+        "p10": get_percentile(0.1),
+        "p50": get_percentile(0.5),
+        "p90": get_percentile(0.9),
+    }
+
+
+def get_hazard(requests, banned):
+    bucket = np.searchsorted(BUCKETS, requests, side="right") - 1
+    ended = np.bincount(bucket, minlength=BUCKETS.size)
+    bans = np.bincount(bucket, weights=banned, minlength=BUCKETS.size)
+    # Sessions that got at least as far as the bucket
+    at_risk = ended[::-1].cumsum()[::-1]
+    hazard = np.divide(
+        bans, at_risk, out=np.zeros(BUCKETS.size), where=at_risk > 0
+    )
+
+    return [
+        {
+            "bucket": f"{BUCKETS[i]}+" if i == BUCKETS.size - 1 else f"{BUCKETS[i]}-{BUCKETS[i + 1] - 1}",
+            "at_risk": int(at_risk[i]),
+            "bans": int(bans[i]),
+            "hazard": round(float(hazard[i]), 4),
+        }
+        for i in range(BUCKETS.size)
+    ]
+
+
+def get_summary(accounts, requests, banned):
+    sessions = int(requests.size)
+    bans = int(banned.sum())
+    return {
+        "sessions": sessions,
+        "bans": bans,
+        "ban_rate": round(bans / sessions, 4) if sessions else 0,
+        "yield": get_yield(accounts, requests, banned),
+        "hazard": get_hazard(requests, banned),
+    }
+
+
+def compare_proxies(proxies, requests, banned):
+    ids, index = np.unique(proxies, return_inverse=True)
+    sessions = np.bincount(index)
+    bans = np.bincount(index, weights=banned)
+    total = np.bincount(index, weights=requests)
+
+    keep = (ids != 0) & (sessions >= MIN_PROXY_SESSIONS)
+    ids, sessions, bans, total = ids[keep], sessions[keep], bans[keep], total[keep]
+    ban_rate = bans / np.maximum(sessions, 1)
+    requests_per_ban = np.divide(
+        total, bans, out=np.full(ids.size, np.nan), where=bans > 0
+    )
+
+    titles = {
+        proxy.id: str(proxy)
+        for proxy in Proxy.objects.filter(id__in=ids.tolist())
+    }
+    order = np.argsort(-ban_rate, kind="stable")
+    return [
+        {
+            "proxy": titles.get(int(ids[i]), int(ids[i])),
+            "sessions": int(sessions[i]),
+            "bans": int(bans[i]),
+            "ban_rate": round(float(ban_rate[i]), 4),
+            "requests_per_ban": None if np.isnan(requests_per_ban[i]) else round(float(requests_per_ban[i]), 1),
+        }
+        for i in order
+    ]
+
+
+def build_report(days=None):
+    days = days or settings.ANALYTICS_DAYS
+    accounts, proxies, networks, requests, banned = load_sessions(
+        timezone.now() - timedelta(days=days)
+    )
+
+    report = {
+        "generated": timezone.now().isoformat(),
+        "days": days,
+        "total": get_summary(accounts, requests, banned),
+        "networks": [],
+        "dynamic_limits": [],
+        "proxies": compare_proxies(proxies, requests, banned),
+    }
+
+    dynamic = np.zeros(networks.size, bool)
+    for network in Network.objects.order_by("title"):
+        mask = networks == network.id
+        if network.dynamic_limits:
+            dynamic |= mask
+        if mask.any():
+            report["networks"].append({
+                "network": network.title,
+                "dynamic_limits": network.dynamic_limits,
+                **get_summary(accounts[mask], requests[mask], banned[mask]),
+            })
+
+    for enabled in (True, False):
+        mask = dynamic if enabled else ~dynamic
+        if mask.any():
+            report["dynamic_limits"].append({
+                "enabled": enabled,
+                **get_summary(accounts[mask], requests[mask], banned[mask]),
+            })
+
+    return report
+
+
+def write_report(report):
+    path = settings.ANALYTICS_REPORT_PATH
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.tmp", "wb") as file:
+        file.write(orjson.dumps(report))
+    os.replace(f"{path}.tmp", path)
+
+
+def read_report():
+    try:
+        with open(settings.ANALYTICS_REPORT_PATH, "rb") as file:
+            return orjson.loads(file.read())
+    except FileNotFoundError:
+        return None
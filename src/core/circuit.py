@@ -0,0 +1,132 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, Count, F, Value, When
+from django.utils import timezone
+from loguru import logger
+
+from conf.celery import app
+from core import metrics, signals
+from core.models import CredentialsProxy, Proxy, ProxyFailure
+
+
+def record_failure(proxy_id, credentials_proxy_id=None):
+    now = timezone.now()
+    since = now - timedelta(seconds=settings.CIRCUIT_WINDOW)
+
+    ProxyFailure.objects.create(
+        proxy_id=proxy_id, credentials_proxy_id=credentials_proxy_id
+    )
+    ProxyFailure.objects.filter(proxy_id=proxy_id, created__lt=since).delete()
+
+    circuit, circuit_changed = Proxy.objects.filter(
+        id=proxy_id
+    ).values_list("circuit", "circuit_changed").first() or (None, None)
+    if circuit in (None, Proxy.Circuit.OPEN):
+        return False
+
+    threshold = settings.CIRCUIT_THRESHOLD
+    if circuit == Proxy.Circuit.HALF_OPEN:
+        # On probation a single failure opens the circuit again
+        threshold, since = 1, max(since, circuit_changed)
+
+    # Distinct accounts, so one account reporting twice (update and
+    # statistics) or one broken account does not trip the proxy
+    failed_accounts = ProxyFailure.objects.filter(
+        proxy_id=proxy_id, created__gte=since,
+    ).aggregate(
+        count=Count("credentials_proxy", distinct=True)
+    )["count"] or 1
+    if failed_accounts < threshold:
+        return False
+    return trip(proxy_id)
+
+
+def trip(proxy_id):
+    now = timezone.now()
+    with transaction.atomic():
+        opened = Proxy.objects.filter(id=proxy_id).exclude(
+            circuit=Proxy.Circuit.OPEN
+        ).update(
+            circuit=Proxy.Circuit.OPEN,
+            circuit_changed=now,
+            # Old value: a proxy disabled by an admin stays disabled
+            circuit_disabled=F("enable"),
+            enable=False,
+            status=Proxy.Status.NOT_AVAILABLE,
+            status_updated=now,
+        )
+        if not opened:
+            return False
+
+        parked = CredentialsProxy.objects.filter(
+            proxy_id=proxy_id,
+            status__in=[
+                CredentialsProxy.Status.AVAILABLE,
+                CredentialsProxy.Status.IN_QUEUE,
+            ],
+        ).update(
+            status=CredentialsProxy.Status.WAITING,
+            status_updated=now,
+            waiting_since=now,
+            lease_expires_at=None,
+            circuit_parked=True,
+        )
+
+    app.send_task(
+        "recheck_proxy", args=(proxy_id,), countdown=settings.CIRCUIT_RECHECK_DELAY
+    )
+    metrics.incr("proxy_circuit_opened")
+    logger.warning(f"proxy: {proxy_id} - CIRCUIT OPENED, {parked} ACCOUNTS PARKED")
+    return True
+
+
+def half_open(proxy):
+    now = timezone.now()
+    with transaction.atomic():
+        opened = Proxy.objects.filter(
+            id=proxy.id, circuit=Proxy.Circuit.OPEN
+        ).update(
+            circuit=Proxy.Circuit.HALF_OPEN,
+            circuit_changed=now,
+            enable=Case(
+                When(circuit_disabled=True, then=Value(True)),
+                default=F("enable"),
+            ),
+            circuit_disabled=False,
+        )
+        if not opened:
+            return False
+
+        # Only the accounts parked by trip(), the rest keep their waits
+        released = list(CredentialsProxy.objects.filter(
+            proxy_id=proxy.id,
+            status=CredentialsProxy.Status.WAITING,
+            circuit_parked=True,
+        ).select_for_update().values_list("id", flat=True))
+        CredentialsProxy.objects.filter(id__in=released).update(
+            status=CredentialsProxy.Status.AVAILABLE,
+            status_updated=now,
+            circuit_parked=False,
+        )
+        signals.publish_on_commit(released)
+
+    app.send_task(
+        "close_circuit",
+        args=(proxy.id, now.isoformat()),
+        countdown=settings.CIRCUIT_HALF_OPEN,
+    )
+    logger.info(f"proxy: {proxy.id} - CIRCUIT HALF OPEN, {len(released)} ACCOUNTS RELEASED")
+    return True
+
+
+def close(proxy_id, circuit_changed):
+    closed = Proxy.objects.filter(
+        id=proxy_id,
+        circuit=Proxy.Circuit.HALF_OPEN,
+        circuit_changed=circuit_changed,
+    ).update(circuit=Proxy.Circuit.CLOSED, circuit_changed=timezone.now())
+    if closed:
+        logger.info(f"proxy: {proxy_id} - CIRCUIT CLOSED")
+    return bool(closed)
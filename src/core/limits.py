@@ -0,0 +1,77 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Max, Min, Q
+from django.utils import timezone
+
+from core.models import (
+    CredentialsLimits,
+    CredentialsStatistics,
+    CredentialsStatisticsRequest,
+    ParsingType,
+)
+
+BAN_STATUSES = (
+    CredentialsStatistics.Status.BANNED,
+    CredentialsStatistics.Status.TEMPORARILY_BANNED,
+)
+
+
+def get_safe_limit(max_ok, min_ban, type_limit):
+    if min_ban is not None:
+        # Stay below the smallest request count an account was banned at
+        limit = int(min_ban * settings.LIMITS_SAFETY)
+    else:
+        # Nothing went wrong yet, probe a bit further than the best session
+        limit = int(max_ok * settings.LIMITS_GROWTH) + 1
+    return min(max(1, limit), type_limit)
+
+
+def plan_limits():
+    started = timezone.now()
+    since = started - timedelta(days=settings.LIMITS_WINDOW)
+    type_limits = {
+        (network_id, title): limit
+        for network_id, title, limit in ParsingType.objects.filter(
+            network__dynamic_limits=True
+        ).values_list("network_id", "title", "limit")
+    }
+
+    outcomes = CredentialsStatisticsRequest.objects.filter(
+        statistics__end_time_of_use__gte=since,
+        # Statistics outlive their deleted accounts
+        statistics__credentials_proxy__isnull=False,
+        parsing_type__network__dynamic_limits=True,
+    ).values(
+        "statistics__credentials_proxy_id",
+        "parsing_type__network_id",
+        "parsing_type_title",
+    ).annotate(
+        max_ok=Max("requests", filter=~Q(statistics__result_status__in=BAN_STATUSES)),
+        min_ban=Min("requests", filter=Q(statistics__result_status__in=BAN_STATUSES)),
+    ).order_by()
+
+    plans = {}
+    for outcome in outcomes.iterator():
+        type_limit = type_limits.get(
+            (outcome["parsing_type__network_id"], outcome["parsing_type_title"])
+        )
+        if type_limit is None:
+            continue
+        plans.setdefault(outcome["statistics__credentials_proxy_id"], {})[
+            outcome["parsing_type_title"]
+        ] = get_safe_limit(outcome["max_ok"] or 0, outcome["min_ban"], type_limit)
+
+    CredentialsLimits.objects.bulk_create(
+        [
+            CredentialsLimits(credentials_proxy_id=credentials_proxy_id, limits=limits)
+            for credentials_proxy_id, limits in plans.items()
+        ],
+        batch_size=1000,
+        update_conflicts=True,
+        unique_fields=["credentials_proxy_id"],
+        update_fields=["limits", "updated"],
+    )
+    # Accounts without recent history fall back to the counter heuristic
+    CredentialsLimits.objects.filter(updated__lt=started).delete()
+    return len(plans)
@@ -0,0 +1,47 @@
+from contextlib import contextmanager
+from functools import wraps
+import hashlib
+
+from django.db import connection
+from loguru import logger
+
+from core import metrics
+
+
+def get_lock_key(name):
+    return int.from_bytes(
+        hashlib.sha1(name.encode()).digest()[:8], "big", signed=True
+    )
+
+
+@contextmanager
+def advisory_lock(name):
+    # Session level lock: it is held across transactions and released by
+    # PostgreSQL when the holding connection goes away, so a killed worker
+    # does not leave a stale lock behind.
+    if connection.vendor != "postgresql":
+        yield True
+        return
+
+    key = get_lock_key(name)
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_try_advisory_lock(%s)", [key])
+        acquired = cursor.fetchone()[0]
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_unlock(%s)", [key])
+
+
+def skip_if_running(func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with advisory_lock(f"task:{func.__name__}") as acquired:
+            if not acquired:
+                metrics.incr(f"skipped_{func.__name__}")
+                logger.info(f"{func.__name__.upper()} IS ALREADY RUNNING, SKIPPED")
+                return
+            return func(*args, **kwargs)
+    return wrapper
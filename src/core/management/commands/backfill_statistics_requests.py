@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Exists, F, OuterRef
+
+from core.models import (
+    CredentialsStatistics,
+    CredentialsStatisticsRequest,
+    ParsingType,
+)
+
+
+class Command(BaseCommand):
+    help = 'Заполнение запросов по типам парсинга для существующей статистики'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=5000)
+
+    def handle(self, *args, **options):
+        chunk_size = options["chunk_size"]
+
+        parsing_types = {}
+        for network_id, title, parsing_type_id in ParsingType.objects.values_list(
+            "network_id", "title", "id"
+        ):
+            parsing_types.setdefault(network_id, {})[title] = parsing_type_id
+
+        queryset = CredentialsStatistics.objects.filter(
+            ~Exists(CredentialsStatisticsRequest.objects.filter(statistics=OuterRef("pk")))
+        ).order_by("id")
+
+        last_id, total = 0, 0
+        while True:
+            chunk = list(
+                queryset.filter(id__gt=last_id).only(
+                    "id", "request_count", "limit",
+                ).annotate(
+                    network_id=F("credentials_proxy__credentials__network_id")
+                )[:chunk_size]
+            )
+            if not chunk:
+                break
+
+            rows = []
+            for statistics in chunk:
+                rows.extend(CredentialsStatisticsRequest.build(
+                    statistics, parsing_types.get(statistics.network_id, {})
+                ))
+            CredentialsStatisticsRequest.objects.bulk_create(rows)
+
+            last_id = chunk[-1].id
+            total += len(rows)
+            self.stdout.write(f"statistics: {last_id} - {total} rows")
+
+        self.stdout.write(self.style.SUCCESS(f"Добавлено записей: {total}"))
+
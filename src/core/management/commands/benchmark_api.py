@@ -0,0 +1,62 @@
+import gzip
+import time
+
+import brotli
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+from rest_framework.renderers import JSONRenderer
+
+from core.models import CredentialsProxy, Proxy
+from core.renderers import ORJSONRenderer
+from core.serializers import (
+    ProxySerializer, load_network_types, make_account_payload,
+)
+
+
+class Command(BaseCommand):
+    help = 'Сравнение скорости рендеринга и сжатия ответов API'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        network_types = load_network_types()
+        payloads = {
+            "credentials": [
+                make_account_payload(credentials_proxy, network_types)
+                for credentials_proxy in CredentialsProxy.objects.select_related(
+                    "credentials", "credentials__network", "proxy", "limit_plan"
+                )
+            ],
+            "proxy": ProxySerializer(Proxy.objects.annotate(
+                related_accounts_count=Count("credentials_proxy")
+            ), many=True).data,
+        }
+
+        for title, data in payloads.items():
+            for renderer in (JSONRenderer(), ORJSONRenderer()):
+                best = min(
+                    self.measure(renderer.render, data)
+                    for _ in range(options['repeat'])
+                )
+                self.stdout.write(
+                    f"{title} {type(renderer).__name__}: {best * 1000:.2f} ms"
+                )
+
+            content = ORJSONRenderer().render(data)
+            for encoding, compress in (
+                ("gzip", gzip.compress),
+                ("br", lambda value: brotli.compress(value, quality=5)),
+            ):
+                started = time.perf_counter()
+                compressed = compress(content)
+                self.stdout.write(
+                    f"{title} {encoding}: {len(content)} -> {len(compressed)}"
+                    f" bytes in {(time.perf_counter() - started) * 1000:.2f} ms"
+                )
+
+    @staticmethod
+    def measure(render, data):
+        started = time.perf_counter()
+        render(data)
+        return time.perf_counter() - started
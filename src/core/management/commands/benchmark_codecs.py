@@ -0,0 +1,68 @@
+import time
+
+from django.core.management.base import BaseCommand
+from kombu.compression import compress, decompress
+from kombu.serialization import dumps, loads, prepare_accept_content
+
+from core import amqp
+from core.models import CredentialsProxy
+from core.serializers import load_network_types, make_account_payload
+
+
+class Command(BaseCommand):
+    help = 'Сравнение размера и скорости кодеков сообщений очереди'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        network_types = load_network_types()
+        payloads = [
+            make_account_payload(credentials_proxy, network_types)
+            for credentials_proxy in CredentialsProxy.objects.select_related(
+                "credentials", "credentials__network", "proxy", "limit_plan"
+            )[:options['count']]
+        ]
+        if not payloads:
+            self.stdout.write(self.style.WARNING("Нет аккаунтов"))
+            return
+
+        for codec, codec_options in amqp.CODECS.items():
+            started = time.perf_counter()
+            messages = [
+                self.encode(payload, **codec_options) for payload in payloads
+            ]
+            encoded = time.perf_counter() - started
+
+            started = time.perf_counter()
+            decoded = [self.decode(*message) for message in messages]
+            elapsed = time.perf_counter() - started
+
+            if decoded != payloads:
+                self.stdout.write(self.style.ERROR(f"{codec}: round-trip failed"))
+                continue
+
+            size = sum(len(message[0]) for message in messages)
+            self.stdout.write(
+                f"{codec}: {size / len(payloads):.0f} bytes/message, "
+                f"encode {encoded / len(payloads) * 1_000_000:.1f} us, "
+                f"decode {elapsed / len(payloads) * 1_000_000:.1f} us"
+            )
+
+    @staticmethod
+    def encode(payload, serializer, compression=None):
+        content_type, content_encoding, body = dumps(payload, serializer)
+        if compression:
+            body, compression = compress(body, compression)
+        return body, content_type, content_encoding, compression
+
+    @staticmethod
+    def decode(body, content_type, content_encoding, compression):
+        if compression:
+            body = decompress(body, compression)
+        return loads(
+            body,
+            content_type,
+            content_encoding,
+            accept=prepare_accept_content(amqp.ACCEPT),
+        )
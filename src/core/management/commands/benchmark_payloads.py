@@ -0,0 +1,67 @@
+import json
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.models import CredentialsProxy
+from core.serializers import (
+    CredentialsProxySerializer,
+    attach_cookies,
+    load_network_types,
+    make_account_payload,
+)
+
+
+class Command(BaseCommand):
+    help = 'Сравнение скорости сериализации аккаунтов для очереди'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=1000)
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        accounts = list(CredentialsProxy.objects.select_related(
+            "credentials", "credentials__network", "proxy", "limit_plan", "cookie_jar"
+        ).prefetch_related(
+            "credentials__network__types"
+        )[:options['count']])
+        if not accounts:
+            self.stdout.write(self.style.WARNING("Нет аккаунтов"))
+            return
+
+        network_types = load_network_types()
+
+        random.seed(0)
+        drf_payloads = [
+            CredentialsProxySerializer(account).data for account in accounts
+        ]
+        random.seed(0)
+        fast_payloads = attach_cookies([
+            make_account_payload(account, network_types)
+            for account in accounts
+        ])
+        if json.dumps(drf_payloads) != json.dumps(fast_payloads):
+            self.stdout.write(self.style.ERROR("Результаты различаются"))
+            return
+
+        for title, serialize in (
+            ("drf", lambda account: CredentialsProxySerializer(account).data),
+            ("fast", lambda account: make_account_payload(
+                account, network_types
+            )),
+        ):
+            best = min(
+                self.measure(serialize, accounts)
+                for _ in range(options['repeat'])
+            )
+            self.stdout.write(
+                f"{title}: {best / len(accounts) * 1_000_000:.1f} us/account"
+            )
+
+    @staticmethod
+    def measure(serialize, accounts):
+        started = time.perf_counter()
+        for account in accounts:
+            serialize(account)
+        return time.perf_counter() - started
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from core import analytics
+
+
+class Command(BaseCommand):
+    help = 'Расчет отчета по банам и выработке аккаунтов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int)
+
+    def handle(self, *args, **options):
+        report = analytics.build_report(options['days'])
+        analytics.write_report(report)
+
+        total = report["total"]
+        self.stdout.write(
+            f"Сессий: {total['sessions']}, банов: {total['bans']}, "
+            f"доля банов: {total['ban_rate']}"
+        )
+        for network in report["networks"]:
+            self.stdout.write(
+                f"{network['network']} (dynamic_limits={network['dynamic_limits']}): "
+                f"сессий {network['sessions']}, доля банов {network['ban_rate']}, "
+                f"выработка {network['yield']}"
+            )
+        self.stdout.write(self.style.SUCCESS("Отчет сохранен"))
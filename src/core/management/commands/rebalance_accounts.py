@@ -0,0 +1,51 @@
+from collections import Counter
+
+from django.core.management.base import BaseCommand
+
+from core import rebalancer
+from core.models import Network, Proxy
+
+
+class Command(BaseCommand):
+    help = 'Перераспределение аккаунтов по прокси'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Только показать план перемещений',
+        )
+        parser.add_argument('--cap', type=int)
+
+    def handle(self, *args, **options):
+        moves, unplaced, moved = rebalancer.rebalance(
+            dry_run=options['dry_run'], cap=options['cap']
+        )
+
+        networks = dict(Network.objects.values_list("id", "title"))
+        proxies = {
+            proxy.id: str(proxy) for proxy in Proxy.objects.filter(
+                id__in={move.source for move in moves} | {move.target for move in moves}
+            )
+        }
+        for move in moves:
+            self.stdout.write(
+                f"{networks[move.network_id]}: cred {move.credentials_proxy_id} "
+                f"{proxies[move.source]} -> {proxies[move.target]} ({move.reason})"
+            )
+
+        for reason, count in Counter(move.reason for move in moves).items():
+            self.stdout.write(f"{reason}: {count}")
+        if unplaced:
+            self.stdout.write(self.style.WARNING(
+                f"Не хватило места на прокси для {unplaced} аккаунтов"
+            ))
+
+        if options['dry_run']:
+            self.stdout.write(self.style.SUCCESS(
+                f"Запланировано перемещений: {len(moves)}"
+            ))
+        else:
+            self.stdout.write(self.style.SUCCESS(
+                f"Перемещено аккаунтов: {moved} из {len(moves)}"
+            ))
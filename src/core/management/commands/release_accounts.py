@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from core import amqp
+from core.tasks import release_account
+
+
+class Command(BaseCommand):
+    help = 'Возврат аккаунтов из ожидания по истечении waiting_delta'
+
+    def handle(self, *args, **options):
+        self.stdout.write("Ожидание сообщений на освобождение аккаунтов")
+        amqp.consume_releases(release_account)
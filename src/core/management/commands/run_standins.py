@@ -0,0 +1,105 @@
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from core import standins
+from core.models import Proxy, ProxyCheck
+
+
+class Command(BaseCommand):
+    help = 'Локальный ip-echo сервер и тестовые прокси для проверки прокси без сети'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--echo-port', type=int, default=8081)
+        parser.add_argument('--proxy-port', type=int, default=8090)
+        parser.add_argument('--proxies', type=int, default=1)
+        parser.add_argument('--delay', type=float, default=0)
+        parser.add_argument('--fail-rate', type=float, default=0)
+        parser.add_argument('--login')
+        parser.add_argument('--password')
+        parser.add_argument(
+            '--register',
+            action='store_true',
+            help='Добавить тестовые прокси в базу',
+        )
+        parser.add_argument(
+            '--check',
+            type=int,
+            default=0,
+            help='Прогнать проверку тестовых прокси N раз и завершиться',
+        )
+
+    def handle(self, *args, **options):
+        host = options['host']
+        echo = standins.serve_in_thread(
+            standins.IPEchoServer((host, options['echo_port']))
+        )
+        proxies = [
+            standins.serve_in_thread(standins.FakeProxy(
+                (host, options['proxy_port'] + i),
+                delay=options['delay'],
+                fail_rate=options['fail_rate'],
+                login=options['login'],
+                password=options['password'],
+            ))
+            for i in range(options['proxies'])
+        ]
+
+        echo_url = f"http://{host}:{echo.server_address[1]}/"
+        self.stdout.write(f"ip-echo: {echo_url}")
+        for proxy in proxies:
+            self.stdout.write(f"proxy: {host}:{proxy.server_address[1]}")
+
+        if options['register'] or options['check']:
+            for proxy in proxies:
+                Proxy.objects.update_or_create(
+                    ip=host,
+                    port=str(proxy.server_address[1]),
+                    defaults={
+                        "login": options['login'],
+                        "password": options['password'],
+                        "enable": True,
+                    },
+                )
+
+        if options['check']:
+            with override_settings(PROXY_CHECK_URL=echo_url):
+                self.check(host, proxies, options['check'])
+        else:
+            self.stdout.write(
+                f"PROXY_CHECK_URL={echo_url}, Ctrl+C для остановки"
+            )
+            try:
+                threading.Event().wait()
+            except KeyboardInterrupt:
+                pass
+
+        for server in [echo, *proxies]:
+            server.shutdown()
+            server.server_close()
+
+    def check(self, host, servers, rounds):
+        proxies = list(Proxy.objects.filter(
+            ip=host,
+            port__in=[str(server.server_address[1]) for server in servers],
+        ))
+        started = time.perf_counter()
+        for _ in range(rounds):
+            for proxy in proxies:
+                proxy.enable = True
+                proxy.update_status()
+        elapsed = time.perf_counter() - started
+
+        ProxyCheck.summarize()
+        checks = rounds * len(proxies)
+        self.stdout.write(
+            f"Проверок: {checks}, {checks / elapsed:.1f} в секунду"
+        )
+        for proxy in Proxy.objects.filter(id__in=[proxy.id for proxy in proxies]):
+            self.stdout.write(
+                f"{proxy}: {proxy.status}, p50 {proxy.latency_p50} ms, "
+                f"p95 {proxy.latency_p95} ms, успешных {proxy.success_rate}"
+            )
@@ -0,0 +1,21 @@
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from core.models import Metric
+
+
+def incr(name, value=1):
+    if not value:
+        return
+
+    period = timezone.now().replace(minute=0, second=0, microsecond=0)
+    metrics = Metric.objects.filter(name=name, period=period)
+    if metrics.update(value=F("value") + value):
+        return
+
+    try:
+        with transaction.atomic():
+            Metric.objects.create(name=name, period=period, value=value)
+    except IntegrityError:
+        metrics.update(value=F("value") + value)
@@ -0,0 +1,48 @@
+from django.middleware.gzip import GZipMiddleware
+from django.utils.cache import patch_vary_headers
+from django.utils.regex_helper import _lazy_re_compile
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+re_accepts_brotli = _lazy_re_compile(r"\bbr\b")
+
+
+class CompressionMiddleware(GZipMiddleware):
+    # brotli when the client accepts it, gzip otherwise; only API responses
+    # are compressed, admin pages carry CSRF tokens (BREACH).
+    prefix = "/api/"
+    brotli_quality = 5
+
+    def process_response(self, request, response):
+        if not request.path.startswith(self.prefix):
+            return response
+
+        ae = request.META.get("HTTP_ACCEPT_ENCODING", "")
+        if brotli is None or not re_accepts_brotli.search(ae):
+            return super().process_response(request, response)
+
+        if response.streaming or len(response.content) < 200:
+            return response
+        if response.has_header("Content-Encoding"):
+            return response
+
+        patch_vary_headers(response, ("Accept-Encoding",))
+
+        compressed_content = brotli.compress(
+            response.content, quality=self.brotli_quality
+        )
+        if len(compressed_content) >= len(response.content):
+            return response
+
+        response.content = compressed_content
+        response.headers["Content-Length"] = str(len(response.content))
+
+        etag = response.get("ETag")
+        if etag and etag.startswith('"'):
+            response.headers["ETag"] = "W/" + etag
+        response.headers["Content-Encoding"] = "br"
+
+        return response
@@ -0,0 +1,22 @@
+# Generated by Django 4.1.2 on 2026-10-19 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0029_remove_proxy_today_notification_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='network',
+            name='priority_delivery',
+            field=models.BooleanField(default=False, help_text='Healthier accounts are handed out first'),
+        ),
+        migrations.AddIndex(
+            model_name='credentialsstatistics',
+            index=models.Index(fields=['credentials_proxy', 'end_time_of_use'], name='statistics_account_end_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.1.2 on 2026-10-19 10:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0030_network_priority_delivery_statistics_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Metric',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('period', models.DateTimeField()),
+                ('value', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'метрика',
+                'verbose_name_plural': 'метрики',
+            },
+        ),
+        migrations.AddField(
+            model_name='credentialsproxy',
+            name='lease_expires_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='credentialsproxy',
+            index=models.Index(fields=['status', 'lease_expires_at'], name='credentials_proxy_lease_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='metric',
+            constraint=models.UniqueConstraint(fields=('name', 'period'), name='metric_name_period_constraint'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.1.2 on 2026-10-19 10:02
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0031_credentialsproxy_lease_expires_at_metric'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Notification',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('rent_expires_tomorrow', 'Rent Expires Tomorrow'), ('rent_expires_today', 'Rent Expires Today')], max_length=255)),
+                ('subject', models.CharField(max_length=255)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('sent', models.DateTimeField(blank=True, null=True)),
+                ('attempts', models.IntegerField(default=0)),
+                ('next_attempt', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'verbose_name': 'уведомление',
+                'verbose_name_plural': 'уведомления',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['sent', 'next_attempt'], name='notification_pending_idx'),
+        ),
+    ]
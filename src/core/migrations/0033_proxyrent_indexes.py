@@ -0,0 +1,21 @@
+# Generated by Django 4.1.2 on 2026-10-19 10:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0032_notification'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='proxyrent',
+            index=models.Index(fields=['proxy', '-id'], name='proxy_rent_latest_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='proxyrent',
+            index=models.Index(fields=['expiration_date'], name='proxy_rent_expiration_idx'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.1.2 on 2026-10-19 10:04
+
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations, models
+import django.db.models.functions.text
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0033_proxyrent_indexes'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddIndex(
+            model_name='credentials',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('login'), name='gin_trgm_ops'), name='credentials_login_trgm_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='credentialsstatistics',
+            index=models.Index(fields=['end_time_of_use'], name='statistics_end_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='credentialsstatistics',
+            index=models.Index(fields=['result_status', 'end_time_of_use'], name='statistics_status_end_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='proxy',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('ip'), name='gin_trgm_ops'), name='proxy_ip_trgm_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.2 on 2026-10-19 10:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0034_admin_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='network',
+            name='message_codec',
+            field=models.CharField(choices=[('json', 'Json'), ('msgpack', 'Msgpack'), ('msgpack+zstd', 'Msgpack Zstd')], default='json', max_length=255),
+        ),
+    ]
@@ -0,0 +1,74 @@
+# Generated by Django 4.1.2 on 2026-10-19 10:11
+
+import hashlib
+import zlib
+
+from django.db import migrations, models
+import django.db.models.deletion
+import orjson
+
+CHUNK_SIZE = 1000
+
+
+def move_cookies(apps, schema_editor):
+    CredentialsProxy = apps.get_model('core', 'CredentialsProxy')
+    CredentialsCookies = apps.get_model('core', 'CredentialsCookies')
+
+    credentials_proxies = CredentialsProxy.objects.filter(
+        cookies__isnull=False
+    ).values_list('id', 'cookies').order_by('id')
+
+    last_id = 0
+    while True:
+        chunk = list(credentials_proxies.filter(id__gt=last_id)[:CHUNK_SIZE])
+        if not chunk:
+            break
+        CredentialsCookies.objects.bulk_create([
+            CredentialsCookies(
+                credentials_proxy_id=credentials_proxy_id,
+                data=zlib.compress(orjson.dumps(cookies)),
+                digest=hashlib.sha256(
+                    orjson.dumps(cookies, option=orjson.OPT_SORT_KEYS)
+                ).hexdigest(),
+            )
+            for credentials_proxy_id, cookies in chunk
+        ])
+        last_id = chunk[-1][0]
+
+
+def restore_cookies(apps, schema_editor):
+    CredentialsProxy = apps.get_model('core', 'CredentialsProxy')
+    CredentialsCookies = apps.get_model('core', 'CredentialsCookies')
+
+    for cookie_jar in CredentialsCookies.objects.iterator(chunk_size=CHUNK_SIZE):
+        CredentialsProxy.objects.filter(
+            id=cookie_jar.credentials_proxy_id
+        ).update(cookies=orjson.loads(zlib.decompress(cookie_jar.data)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0035_network_message_codec'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CredentialsCookies',
+            fields=[
+                ('credentials_proxy', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='cookie_jar', serialize=False, to='core.credentialsproxy')),
+                ('data', models.BinaryField()),
+                ('digest', models.CharField(max_length=64)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'cookies аккаунта',
+                'verbose_name_plural': 'cookies аккаунтов',
+            },
+        ),
+        migrations.RunPython(move_cookies, restore_cookies),
+        migrations.RemoveField(
+            model_name='credentialsproxy',
+            name='cookies',
+        ),
+    ]
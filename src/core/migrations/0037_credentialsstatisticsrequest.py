@@ -0,0 +1,33 @@
+# Generated by Django 4.1.2 on 2026-10-19 10:13
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0036_credentialscookies'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CredentialsStatisticsRequest',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('parsing_type_title', models.CharField(max_length=255)),
+                ('requests', models.IntegerField(default=0)),
+                ('limit', models.IntegerField(blank=True, null=True)),
+                ('parsing_type', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='statistics_requests', to='core.parsingtype')),
+                ('statistics', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='requests', to='core.credentialsstatistics')),
+            ],
+            options={
+                'verbose_name': 'запросы по типу парсинга',
+                'verbose_name_plural': 'запросы по типам парсинга',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='credentialsstatisticsrequest',
+            index=models.Index(fields=['parsing_type', 'statistics'], name='statistics_request_type_idx'),
+        ),
+    ]
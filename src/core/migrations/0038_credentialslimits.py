@@ -0,0 +1,26 @@
+# Generated by Django 4.1.2 on 2026-10-19 10:16
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0037_credentialsstatisticsrequest'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CredentialsLimits',
+            fields=[
+                ('credentials_proxy', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='limit_plan', serialize=False, to='core.credentialsproxy')),
+                ('limits', models.JSONField(default=dict)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'плановые лимиты аккаунта',
+                'verbose_name_plural': 'плановые лимиты аккаунтов',
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.2 on 2026-10-19 10:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0038_credentialslimits'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='network',
+            name='queue_shards',
+            field=models.PositiveSmallIntegerField(default=1, help_text='Accounts are spread over this many queues by proxy. Queued accounts of removed shards come back with the queue lease'),
+        ),
+    ]
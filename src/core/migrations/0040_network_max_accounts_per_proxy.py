@@ -0,0 +1,18 @@
+# Generated by Django 4.1.2 on 2026-10-19 10:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0039_network_queue_shards'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='network',
+            name='max_accounts_per_proxy',
+            field=models.PositiveSmallIntegerField(blank=True, help_text='Accounts in queue or sent per proxy, empty for no limit', null=True),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 4.1.2 on 2026-10-19 10:21
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0040_network_max_accounts_per_proxy'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='proxy',
+            name='circuit',
+            field=models.CharField(choices=[('closed', 'Closed'), ('open', 'Open'), ('half_open', 'Half Open')], default='closed', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='proxy',
+            name='circuit_changed',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='credentialsstatistics',
+            name='result_status',
+            field=models.CharField(choices=[('not_available', 'Not Available'), ('login_failed', 'Login Failed'), ('temporarily_banned', 'Temporarily Banned'), ('banned', 'Banned'), ('waiting', 'Waiting'), ('proxy_error', 'Proxy Error')], max_length=255),
+        ),
+        migrations.CreateModel(
+            name='ProxyFailure',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('credentials_proxy', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='core.credentialsproxy')),
+                ('proxy', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='failures', to='core.proxy')),
+            ],
+            options={
+                'verbose_name': 'ошибка прокси',
+                'verbose_name_plural': 'ошибки прокси',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='proxyfailure',
+            index=models.Index(fields=['proxy', 'created'], name='proxy_failure_created_idx'),
+        ),
+    ]
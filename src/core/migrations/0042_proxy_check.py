@@ -0,0 +1,54 @@
+# Generated by Django 4.1.2 on 2026-10-19 10:22
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0041_proxy_circuit_breaker'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='proxy',
+            name='connect_p50',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='proxy',
+            name='latency_p50',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='proxy',
+            name='latency_p95',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='proxy',
+            name='success_rate',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='ProxyCheck',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('success', models.BooleanField(default=False)),
+                ('connect_ms', models.IntegerField(null=True)),
+                ('total_ms', models.IntegerField(null=True)),
+                ('proxy', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='checks', to='core.proxy')),
+            ],
+            options={
+                'verbose_name': 'проверка прокси',
+                'verbose_name_plural': 'проверки прокси',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='proxycheck',
+            index=models.Index(fields=['proxy', 'created'], name='proxy_check_created_idx'),
+        ),
+    ]
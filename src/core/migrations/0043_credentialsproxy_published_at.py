@@ -0,0 +1,18 @@
+# Generated by Django 4.1.2 on 2026-10-19 10:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0042_proxy_check'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='credentialsproxy',
+            name='published_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.2 on 2026-10-19 10:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0043_credentialsproxy_published_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='credentialsproxy',
+            name='publish_token',
+            field=models.UUIDField(blank=True, null=True),
+        ),
+    ]
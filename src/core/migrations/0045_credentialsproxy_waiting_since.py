@@ -0,0 +1,27 @@
+# Generated by Django 4.1.2 on 2026-10-19 10:41
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def set_waiting_since(apps, schema_editor):
+    CredentialsProxy = apps.get_model('core', 'CredentialsProxy')
+    CredentialsProxy.objects.filter(
+        status__in=['waiting', 'temporarily_banned']
+    ).update(waiting_since=F('status_updated'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0044_credentialsproxy_publish_token'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='credentialsproxy',
+            name='waiting_since',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(set_waiting_since, migrations.RunPython.noop),
+    ]
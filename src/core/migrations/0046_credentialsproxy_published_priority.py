@@ -0,0 +1,18 @@
+# Generated by Django 4.1.2 on 2026-10-19 10:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0045_credentialsproxy_waiting_since'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='credentialsproxy',
+            name='published_priority',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.1.2 on 2026-10-19 11:00
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def mark_open_circuits(apps, schema_editor):
+    # Proxies open at the time were disabled by their circuit, accounts
+    # waiting on them since it opened were parked by it
+    Proxy = apps.get_model('core', 'Proxy')
+    CredentialsProxy = apps.get_model('core', 'CredentialsProxy')
+    Proxy.objects.filter(circuit='open').update(circuit_disabled=True)
+    CredentialsProxy.objects.filter(
+        proxy__circuit='open',
+        status='waiting',
+        waiting_since__gte=F('proxy__circuit_changed'),
+    ).update(circuit_parked=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0046_credentialsproxy_published_priority'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='credentialsproxy',
+            name='circuit_parked',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='proxy',
+            name='circuit_disabled',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(mark_open_circuits, migrations.RunPython.noop),
+    ]
@@ -1,9 +1,19 @@
-from datetime import datetime, timedelta
+from datetime import timedelta
+import hashlib
 import logging
-import os
+import time
+import zlib
 
+from django.conf import settings
+from django.contrib.postgres.indexes import GinIndex, OpClass
 from django.db import models
-import requests
+from django.db.models import (
+    Aggregate, Avg, Case, Count, F, FloatField, IntegerField, OuterRef, Q,
+    Subquery, Sum, When,
+)
+from django.db.models.functions import Coalesce, TruncDate, Upper
+from django.utils import timezone
+import orjson
 
 from core.utils import check_proxy
 
@@ -11,8 +21,31 @@ logger = logging.getLogger(__name__)
 
 
 class Network(models.Model):
+    class Codec(models.TextChoices):
+        JSON = "json"
+        MSGPACK = "msgpack"
+        MSGPACK_ZSTD = "msgpack+zstd"
+
     title = models.CharField(max_length=255, unique=True)
     dynamic_limits = models.BooleanField(default=False)
+    priority_delivery = models.BooleanField(
+        default=False,
+        help_text="Healthier accounts are handed out first",
+    )
+    message_codec = models.CharField(
+        max_length=255, choices=Codec.choices, default=Codec.JSON
+    )
+    max_accounts_per_proxy = models.PositiveSmallIntegerField(
+        null=True,
+        blank=True,
+        help_text="Accounts in queue or sent per proxy, empty for no limit",
+    )
+    queue_shards = models.PositiveSmallIntegerField(
+        default=1,
+        help_text="Accounts are spread over this many queues by proxy. "
+                  "Queued accounts of removed shards come back with the "
+                  "queue lease",
+    )
 
     def __str__(self):
         return self.title
@@ -56,6 +89,53 @@ class Credentials(models.Model):
                 fields=["network", "login"], name="network_login_constraint"
             )
         ]
+        indexes = [
+            # Backs admin search, which filters with UPPER(login) LIKE '%...%'
+            GinIndex(
+                OpClass(Upper("login"), name="gin_trgm_ops"),
+                name="credentials_login_trgm_idx",
+            ),
+        ]
+
+
+def latest_rent(field, proxy="pk"):
+    return Subquery(
+        ProxyRent.objects.filter(
+            proxy=OuterRef(proxy)
+        ).order_by("-id").values(field)[:1]
+    )
+
+
+class Percentile(Aggregate):
+    function = "PERCENTILE_CONT"
+    name = "Percentile"
+    output_field = FloatField()
+    template = "%(function)s(%(percentile)s) WITHIN GROUP (ORDER BY %(expressions)s)"
+
+    def __init__(self, expression, percentile, **extra):
+        super().__init__(expression, percentile=float(percentile), **extra)
+
+
+class ProxyQuerySet(models.QuerySet):
+    def with_latest_rent(self):
+        return self.annotate(
+            latest_rent_expiration_date=latest_rent("expiration_date"),
+            latest_rent_price=latest_rent("price"),
+        )
+
+    def by_preference(self, *fields):
+        # Reliable proxies first, then the given fields, then the fastest
+        return self.alias(
+            unreliable=Case(
+                When(
+                    success_rate__lt=settings.PROXY_MIN_SUCCESS_RATE, then=1
+                ),
+                default=0,
+                output_field=IntegerField(),
+            )
+        ).order_by(
+            "unreliable", *fields, F("latency_p95").asc(nulls_last=True), "id"
+        )
 
 
 class Proxy(models.Model):
@@ -68,6 +148,12 @@ class Proxy(models.Model):
         NOT_AVAILABLE = "not_available"
         IP_NOT_EQUAL = "ip_not_equal"
 
+    # Circuit breaker over worker reported proxy errors, see core.circuit
+    class Circuit(models.TextChoices):
+        CLOSED = "closed"
+        OPEN = "open"
+        HALF_OPEN = "half_open"
+
     type = models.CharField(
         max_length=255, choices=Type.choices, default=Type.HTTP
     )
@@ -87,6 +173,21 @@ class Proxy(models.Model):
 
     mobile = models.BooleanField(default=False)
 
+    circuit = models.CharField(
+        max_length=255, choices=Circuit.choices, default=Circuit.CLOSED
+    )
+    circuit_changed = models.DateTimeField(null=True, blank=True)
+    # The circuit disabled the proxy and enables it again on half open
+    circuit_disabled = models.BooleanField(default=False)
+
+    # Summary of the recent ProxyCheck history, in milliseconds
+    connect_p50 = models.IntegerField(null=True, blank=True)
+    latency_p50 = models.IntegerField(null=True, blank=True)
+    latency_p95 = models.IntegerField(null=True, blank=True)
+    success_rate = models.FloatField(null=True, blank=True)
+
+    objects = ProxyQuerySet.as_manager()
+
     def __str__(self):
         return f"{self.ip}:{self.port}"
 
@@ -96,45 +197,26 @@ class Proxy(models.Model):
             self.type = self.type + "h"
         return f"{self.type}://{self.login}:{self.password}@{self.ip}:{self.port}"
 
-    @staticmethod
-    def send_telegram_notification(msg):
-        api_token = os.getenv("TELEGRAM_API_TOKEN")
-        chat_id = os.getenv("TELEGRAM_CHAT_ID")
-        requests.post(
-            f'https://api.telegram.org/bot{api_token}/sendMessage',
-            json={'chat_id': chat_id, 'text': msg}
-        )
-
-    def check_date(self):
-        last_rent = self.rents.last()
-        if not last_rent:
-            return
-
-        if last_rent.expiration_date == (datetime.today() + timedelta(days=1)).date():
-            if not last_rent.tomorrow_notification:
-                self.send_telegram_notification(f"Завтра заканчиваются прокси {self.ip}")
-                last_rent.tomorrow_notification = True
-
-        if last_rent.expiration_date == datetime.today().date():
-            if not last_rent.today_notification:
-                self.send_telegram_notification(f"Сегодня заканчиваются прокси {self.ip}")
-                last_rent.today_notification = True
-
     def update_status(self):
+        check = ProxyCheck(proxy=self)
+        started = time.perf_counter()
         try:
-            result_ip = check_proxy(self.url)
+            result_ip, check.connect_ms = check_proxy(self.url)
         except Exception as e:
             self.status = self.Status.NOT_AVAILABLE
             self.enable = False
             logger.warning(f"Something went wrong with ip: {self.ip}: {e}")
         else:
-            if self.ip == result_ip:
+            check.total_ms = int((time.perf_counter() - started) * 1000)
+            # tcp and socks checks see no exit ip, reachable is enough
+            if result_ip is None or self.ip == result_ip:
                 self.status = self.Status.AVAILABLE
+                check.success = True
             else:
                 self.status = self.Status.IP_NOT_EQUAL
-            self.check_date()
         finally:
             self.save()
+            check.save()
 
     class Meta:
         verbose_name = "прокси"
@@ -144,6 +226,12 @@ class Proxy(models.Model):
                 fields=["ip", "port"], name="ip_port_constraint"
             )
         ]
+        indexes = [
+            GinIndex(
+                OpClass(Upper("ip"), name="gin_trgm_ops"),
+                name="proxy_ip_trgm_idx",
+            ),
+        ]
 
 
 class ProxyRent(models.Model):
@@ -159,6 +247,87 @@ class ProxyRent(models.Model):
     class Meta:
         verbose_name = "аренда прокси"
         verbose_name_plural = "аренда прокси"
+        indexes = [
+            models.Index(
+                fields=["proxy", "-id"], name="proxy_rent_latest_idx"
+            ),
+            models.Index(
+                fields=["expiration_date"], name="proxy_rent_expiration_idx"
+            ),
+        ]
+
+
+class ProxyCheck(models.Model):
+    proxy = models.ForeignKey(
+        Proxy, related_name="checks", on_delete=models.CASCADE
+    )
+    created = models.DateTimeField(default=timezone.now)
+    success = models.BooleanField(default=False)
+    connect_ms = models.IntegerField(null=True)
+    total_ms = models.IntegerField(null=True)
+
+    @classmethod
+    def summarize(cls):
+        # Keeps PROXY_CHECK_WINDOW of history and refreshes the summary
+        # columns on Proxy from it
+        since = timezone.now() - timedelta(days=settings.PROXY_CHECK_WINDOW)
+        cls.objects.filter(created__lt=since).delete()
+
+        summaries = {
+            row.pop("proxy_id"): row
+            for row in cls.objects.values("proxy_id").annotate(
+                connect_p50=Percentile("connect_ms", 0.5),
+                latency_p50=Percentile("total_ms", 0.5),
+                latency_p95=Percentile("total_ms", 0.95),
+                success_rate=Avg(Case(
+                    When(success=True, then=1.0),
+                    default=0.0,
+                    output_field=FloatField(),
+                )),
+            ).order_by()
+        }
+
+        proxies = list(Proxy.objects.only("id"))
+        for proxy in proxies:
+            summary = summaries.get(proxy.id, {})
+            for field in ("connect_p50", "latency_p50", "latency_p95"):
+                value = summary.get(field)
+                setattr(proxy, field, None if value is None else round(value))
+            proxy.success_rate = summary.get("success_rate")
+        Proxy.objects.bulk_update(
+            proxies,
+            ["connect_p50", "latency_p50", "latency_p95", "success_rate"],
+            batch_size=1000,
+        )
+        return len(summaries)
+
+    class Meta:
+        verbose_name = "проверка прокси"
+        verbose_name_plural = "проверки прокси"
+        indexes = [
+            models.Index(
+                fields=["proxy", "created"], name="proxy_check_created_idx"
+            ),
+        ]
+
+
+class ProxyFailure(models.Model):
+    proxy = models.ForeignKey(
+        Proxy, related_name="failures", on_delete=models.CASCADE
+    )
+    credentials_proxy = models.ForeignKey(
+        "CredentialsProxy", on_delete=models.SET_NULL, null=True, blank=True
+    )
+    created = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        verbose_name = "ошибка прокси"
+        verbose_name_plural = "ошибки прокси"
+        indexes = [
+            models.Index(
+                fields=["proxy", "created"], name="proxy_failure_created_idx"
+            ),
+        ]
 
 
 class ProxyCounter(models.Model):
@@ -178,6 +347,50 @@ class ProxyCounter(models.Model):
         ]
 
 
+class CredentialsProxyQuerySet(models.QuerySet):
+    def with_latest_rent(self):
+        return self.annotate(
+            latest_rent_expiration_date=latest_rent(
+                "expiration_date", proxy="proxy"
+            ),
+            latest_rent_price=latest_rent("price", proxy="proxy"),
+        )
+
+    def with_health_penalty(self):
+        since = timezone.now() - CredentialsStatistics.HEALTH_WINDOW
+        penalty = Case(
+            *[
+                When(result_status=status, then=weight)
+                for status, weight
+                in CredentialsStatistics.HEALTH_PENALTIES.items()
+            ],
+            default=0,
+            output_field=IntegerField(),
+        )
+        penalties = CredentialsStatistics.objects.filter(
+            credentials_proxy=OuterRef("pk"),
+            end_time_of_use__gte=since,
+        ).order_by().values("credentials_proxy").annotate(
+            penalty=Sum(penalty)
+        ).values("penalty")
+        return self.annotate(
+            health_penalty=Coalesce(Subquery(penalties), 0)
+        )
+
+    def within_proxy_limit(self):
+        in_flight = self.model.objects.filter(
+            proxy=OuterRef("proxy"),
+            credentials__network=OuterRef("credentials__network"),
+            status__in=self.model.IN_FLIGHT_STATUSES,
+        ).order_by().values("proxy").annotate(count=Count("id")).values("count")
+        return self.alias(
+            proxy_in_flight=Coalesce(Subquery(in_flight), 0)
+        ).filter(
+            Q(credentials__network__max_accounts_per_proxy__isnull=True)
+            | Q(credentials__network__max_accounts_per_proxy__gt=F("proxy_in_flight"))
+        )
+
+
 class CredentialsProxy(models.Model):
     class Status(models.TextChoices):
         AVAILABLE = 'available'
@@ -210,15 +423,63 @@ class CredentialsProxy(models.Model):
     time_of_sent = models.DateTimeField(null=True, blank=True)
     start_time_of_use = models.DateTimeField(null=True, blank=True)
 
-    cookies = models.JSONField(null=True, blank=True)
-
     counter = models.IntegerField(default=0)
 
     token = models.CharField(max_length=255, null=True)
 
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+    # Publish epoch and priority, also sent in the message headers, see
+    # core.reconcile. No priority means the plain FIFO queue.
+    published_at = models.DateTimeField(null=True, blank=True)
+    published_priority = models.PositiveSmallIntegerField(null=True, blank=True)
+    # Token of the last published message, a message carrying another
+    # token is a stale duplicate and is dropped at checkout
+    publish_token = models.UUIDField(null=True, blank=True)
+    # When the account entered WAITING or TEMPORARILY_BANNED. Unlike
+    # status_updated it does not move on saves that keep the status, so
+    # the release of a waiting account is not put off by cookie updates.
+    waiting_since = models.DateTimeField(null=True, blank=True)
+    # Parked in WAITING by an opened proxy circuit, released on half open.
+    # Cleared by any other status change.
+    circuit_parked = models.BooleanField(default=False)
+
+    objects = CredentialsProxyQuerySet.as_manager()
+
+    IN_FLIGHT_STATUSES = [Status.IN_QUEUE, Status.SENT]
+    WAITING_STATUSES = [Status.WAITING, Status.TEMPORARILY_BANNED]
+
+    _loaded_status = None
+
     def __str__(self):
         return str(self.credentials)
 
+    @property
+    def cookies(self):
+        try:
+            return self.cookie_jar.cookies
+        except CredentialsCookies.DoesNotExist:
+            return None
+
+    @property
+    def planned_limits(self):
+        try:
+            return self.limit_plan.limits
+        except CredentialsLimits.DoesNotExist:
+            return {}
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_status = instance.__dict__.get("status")
+        return instance
+
+    def save(self, *args, **kwargs):
+        if self.status != self._loaded_status:
+            self.circuit_parked = False
+            if self.status in self.WAITING_STATUSES:
+                self.waiting_since = timezone.now()
+        super().save(*args, **kwargs)
+
     class Meta:
         verbose_name = "прокси-аккаунт"
         verbose_name_plural = "прокси-аккаунты"
@@ -228,6 +489,85 @@ class CredentialsProxy(models.Model):
                 name="credentials_proxy_constraint",
             )
         ]
+        indexes = [
+            models.Index(
+                fields=["status", "lease_expires_at"],
+                name="credentials_proxy_lease_idx",
+            ),
+        ]
+
+
+class CredentialsCookies(models.Model):
+    credentials_proxy = models.OneToOneField(
+        CredentialsProxy,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="cookie_jar",
+    )
+    data = models.BinaryField()
+    digest = models.CharField(max_length=64)
+    updated = models.DateTimeField(auto_now=True)
+
+    @property
+    def cookies(self):
+        return orjson.loads(zlib.decompress(self.data))
+
+    @staticmethod
+    def get_digest(cookies):
+        return hashlib.sha256(
+            orjson.dumps(cookies, option=orjson.OPT_SORT_KEYS)
+        ).hexdigest()
+
+    @classmethod
+    def store(cls, credentials_proxy_id, cookies):
+        if cookies is None:
+            deleted, _ = cls.objects.filter(pk=credentials_proxy_id).delete()
+            return bool(deleted)
+
+        digest = cls.get_digest(cookies)
+        stored_digest = cls.objects.filter(
+            pk=credentials_proxy_id
+        ).values_list("digest", flat=True).first()
+        if stored_digest == digest:
+            return False
+
+        cls.objects.update_or_create(
+            credentials_proxy_id=credentials_proxy_id,
+            defaults={
+                "data": zlib.compress(orjson.dumps(cookies)),
+                "digest": digest,
+            },
+        )
+        return True
+
+    @classmethod
+    def load(cls, credentials_proxy_ids):
+        return {
+            cookie_jar.pk: cookie_jar.cookies
+            for cookie_jar in cls.objects.filter(
+                pk__in=credentials_proxy_ids
+            ).only("data")
+        }
+
+    class Meta:
+        verbose_name = "cookies аккаунта"
+        verbose_name_plural = "cookies аккаунтов"
+
+
+class CredentialsLimits(models.Model):
+    credentials_proxy = models.OneToOneField(
+        CredentialsProxy,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="limit_plan",
+    )
+    # {parsing type title: limit}, computed by core.limits.plan_limits
+    limits = models.JSONField(default=dict)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "плановые лимиты аккаунта"
+        verbose_name_plural = "плановые лимиты аккаунтов"
 
 
 class CredentialsStatistics(models.Model):
@@ -237,6 +577,15 @@ class CredentialsStatistics(models.Model):
         TEMPORARILY_BANNED = 'temporarily_banned'
         BANNED = 'banned'
         WAITING = 'waiting'
+        PROXY_ERROR = 'proxy_error'
+
+    HEALTH_WINDOW = timedelta(days=1)
+    HEALTH_PENALTIES = {
+        Status.NOT_AVAILABLE: 1,
+        Status.LOGIN_FAILED: 2,
+        Status.TEMPORARILY_BANNED: 3,
+        Status.BANNED: 5,
+    }
 
     credentials_proxy = models.ForeignKey(
         CredentialsProxy,
@@ -264,3 +613,131 @@ class CredentialsStatistics(models.Model):
     class Meta:
         verbose_name = "статистика по аккаунтам"
         verbose_name_plural = "статистика по аккаунтам"
+        indexes = [
+            models.Index(
+                fields=["credentials_proxy", "end_time_of_use"],
+                name="statistics_account_end_idx",
+            ),
+            models.Index(
+                fields=["end_time_of_use"], name="statistics_end_idx"
+            ),
+            models.Index(
+                fields=["result_status", "end_time_of_use"],
+                name="statistics_status_end_idx",
+            ),
+        ]
+
+
+def to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class CredentialsStatisticsRequestQuerySet(models.QuerySet):
+    def usage(self, by_day=False):
+        fields = ["parsing_type_title"]
+        if by_day:
+            fields.append("day")
+            queryset = self.annotate(day=TruncDate("statistics__end_time_of_use"))
+        else:
+            queryset = self
+        return queryset.values(*fields).annotate(
+            requests_sum=Coalesce(Sum("requests"), 0),
+            limit_sum=Coalesce(Sum("limit"), 0),
+            sessions=Count("statistics_id"),
+        ).order_by(*fields)
+
+
+class CredentialsStatisticsRequest(models.Model):
+    statistics = models.ForeignKey(
+        CredentialsStatistics, on_delete=models.CASCADE, related_name="requests"
+    )
+    parsing_type = models.ForeignKey(
+        ParsingType,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="statistics_requests",
+    )
+    parsing_type_title = models.CharField(max_length=255)
+    requests = models.IntegerField(default=0)
+    limit = models.IntegerField(null=True, blank=True)
+
+    objects = CredentialsStatisticsRequestQuerySet.as_manager()
+
+    @classmethod
+    def build(cls, statistics, parsing_types):
+        # parsing_types maps parsing type title to id for the account network
+        request_count = statistics.request_count or {}
+        limit = statistics.limit or {}
+        if not isinstance(request_count, dict) or not isinstance(limit, dict):
+            return []
+
+        return [
+            cls(
+                statistics=statistics,
+                parsing_type_id=parsing_types.get(title),
+                parsing_type_title=title,
+                requests=to_int(request_count.get(title)) or 0,
+                limit=to_int(limit.get(title)),
+            )
+            for title in {**request_count, **limit}
+        ]
+
+    class Meta:
+        verbose_name = "запросы по типу парсинга"
+        verbose_name_plural = "запросы по типам парсинга"
+        indexes = [
+            models.Index(
+                fields=["parsing_type", "statistics"],
+                name="statistics_request_type_idx",
+            ),
+        ]
+
+
+class Metric(models.Model):
+    name = models.CharField(max_length=255)
+    period = models.DateTimeField()
+    value = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.name}: {self.value}"
+
+    class Meta:
+        verbose_name = "метрика"
+        verbose_name_plural = "метрики"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["name", "period"], name="metric_name_period_constraint"
+            )
+        ]
+
+
+class Notification(models.Model):
+    class Kind(models.TextChoices):
+        RENT_EXPIRES_TOMORROW = "rent_expires_tomorrow"
+        RENT_EXPIRES_TODAY = "rent_expires_today"
+
+    kind = models.CharField(max_length=255, choices=Kind.choices)
+    subject = models.CharField(max_length=255)
+
+    created = models.DateTimeField(auto_now_add=True)
+    sent = models.DateTimeField(null=True, blank=True)
+
+    attempts = models.IntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"{self.get_kind_display()}: {self.subject}"
+
+    class Meta:
+        verbose_name = "уведомление"
+        verbose_name_plural = "уведомления"
+        indexes = [
+            models.Index(
+                fields=["sent", "next_attempt"],
+                name="notification_pending_idx",
+            ),
+        ]
@@ -0,0 +1,49 @@
+from collections import defaultdict
+
+from django.conf import settings
+import requests
+
+from core.models import Notification
+
+MESSAGE_LENGTH = 4096
+
+HEADERS = {
+    Notification.Kind.RENT_EXPIRES_TOMORROW: "Завтра заканчиваются прокси",
+    Notification.Kind.RENT_EXPIRES_TODAY: "Сегодня заканчиваются прокси",
+}
+
+session = requests.Session()
+
+
+def send_telegram_message(text):
+    response = session.post(
+        f"{settings.TELEGRAM_API_URL}/bot{settings.TELEGRAM_API_TOKEN}/sendMessage",
+        json={"chat_id": settings.TELEGRAM_CHAT_ID, "text": text},
+        timeout=settings.TELEGRAM_TIMEOUT,
+    )
+    response.raise_for_status()
+
+
+def make_digest(notifications):
+    subjects = defaultdict(list)
+    for notification in notifications:
+        subjects[notification.kind].append(notification.subject)
+
+    return "\n\n".join(
+        f"{HEADERS[kind]} ({len(items)}): {', '.join(items)}"
+        for kind, items in subjects.items()
+    )
+
+
+def split_digest(notifications):
+    # Whole notifications per message, so delivery is recorded per message
+    # and a failed message does not resend the ones before it
+    batches, batch = [], []
+    for notification in notifications:
+        if batch and len(make_digest([*batch, notification])) > MESSAGE_LENGTH:
+            batches.append(batch)
+            batch = []
+        batch.append(notification)
+    if batch:
+        batches.append(batch)
+    return batches
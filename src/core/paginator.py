@@ -0,0 +1,31 @@
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+
+ESTIMATED_COUNT_THRESHOLD = 100_000
+
+
+def get_estimated_count(queryset):
+    connection = connections[queryset.db]
+    if connection.vendor != "postgresql":
+        return None
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass",
+            [queryset.model._meta.db_table],
+        )
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+
+class EstimatedCountPaginator(Paginator):
+    # Exact COUNT(*) over an unfiltered huge table is a full scan, the
+    # planner statistics are good enough to draw the page links.
+    @cached_property
+    def count(self):
+        if not self.object_list.query.where:
+            estimate = get_estimated_count(self.object_list)
+            if estimate and estimate > ESTIMATED_COUNT_THRESHOLD:
+                return estimate
+        return super().count
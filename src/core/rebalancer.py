@@ -0,0 +1,179 @@
+from collections import defaultdict, namedtuple
+import heapq
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count
+from django.utils import timezone
+from loguru import logger
+
+from core import signals
+from core.models import CredentialsProxy, Proxy, ProxyCounter
+
+Move = namedtuple(
+    "Move", ["credentials_proxy_id", "network_id", "source", "target", "reason"]
+)
+
+# Accounts that are dead or disabled do not take a place on a proxy
+LIVE_STATUSES = [
+    CredentialsProxy.Status.AVAILABLE,
+    CredentialsProxy.Status.IN_QUEUE,
+    CredentialsProxy.Status.SENT,
+    CredentialsProxy.Status.NOT_AVAILABLE,
+    CredentialsProxy.Status.PROXY_ERROR,
+    CredentialsProxy.Status.TEMPORARILY_BANNED,
+    CredentialsProxy.Status.WAITING,
+]
+
+# Accounts out with a parser carry their proxy in the payload, leave them be
+MOVABLE_STATUSES = [
+    status for status in LIVE_STATUSES
+    if status not in (CredentialsProxy.Status.IN_QUEUE, CredentialsProxy.Status.SENT)
+]
+
+
+def get_live_accounts():
+    return CredentialsProxy.objects.filter(
+        enable=True,
+        credentials__enable=True,
+        status__in=LIVE_STATUSES,
+    )
+
+
+def get_preference(proxy):
+    # Same order as ProxyQuerySet.by_preference: reliable, then fast
+    unreliable = (
+        proxy.success_rate is not None
+        and proxy.success_rate < settings.PROXY_MIN_SUCCESS_RATE
+    )
+    latency = proxy.latency_p95 if proxy.latency_p95 is not None else float("inf")
+    return unreliable, latency
+
+
+# Healthy proxies of one network: reliable ones first, then least loaded,
+# fastest and least worn
+class Targets:
+    def __init__(self, proxies, load, usage, cap):
+        self.cap = cap
+        self.heaps = {True: [], False: []}
+        for proxy in proxies:
+            if load[proxy.id] < cap:
+                unreliable, latency = get_preference(proxy)
+                self.heaps[proxy.mobile].append(
+                    (unreliable, load[proxy.id], latency, usage[proxy.id], proxy.id)
+                )
+        for heap in self.heaps.values():
+            heapq.heapify(heap)
+
+    def take(self, mobile, fallback=False):
+        for kind in (mobile, not mobile) if fallback else (mobile,):
+            heap = self.heaps[kind]
+            if heap:
+                unreliable, load, *rest = heapq.heappop(heap)
+                if load + 1 < self.cap:
+                    heapq.heappush(heap, (unreliable, load + 1, *rest))
+                return rest[-1]
+
+
+def is_healthy(proxy):
+    return proxy.enable and proxy.status == Proxy.Status.AVAILABLE
+
+
+def plan_moves(cap=None):
+    cap = cap or settings.REBALANCE_PROXY_CAP
+    proxies = {
+        proxy.id: proxy
+        for proxy in Proxy.objects.only(
+            "id", "mobile", "enable", "status", "latency_p95", "success_rate"
+        )
+    }
+    healthy = [proxy for proxy in proxies.values() if is_healthy(proxy)]
+
+    load = defaultdict(lambda: defaultdict(int))
+    for row in get_live_accounts().values(
+        "credentials__network_id", "proxy_id"
+    ).annotate(count=Count("id")).order_by():
+        load[row["credentials__network_id"]][row["proxy_id"]] = row["count"]
+
+    usage = defaultdict(lambda: defaultdict(int))
+    for network_id, proxy_id, counter in ProxyCounter.objects.values_list(
+        "network_id", "proxy_id", "counter"
+    ):
+        usage[network_id][proxy_id] = counter
+
+    movable = defaultdict(lambda: defaultdict(list))
+    for credentials_proxy_id, network_id, proxy_id in get_live_accounts().filter(
+        status__in=MOVABLE_STATUSES
+    ).values_list("id", "credentials__network_id", "proxy_id").order_by("-id"):
+        movable[network_id][proxy_id].append(credentials_proxy_id)
+
+    moves, unplaced = [], 0
+    for network_id, network_load in load.items():
+        targets = Targets(healthy, network_load, usage[network_id], cap)
+
+        # Stranded accounts get the free places first
+        for proxy_id, accounts in sorted(
+            movable[network_id].items(),
+            key=lambda item: is_healthy(proxies[item[0]]),
+        ):
+            proxy = proxies[proxy_id]
+            if is_healthy(proxy):
+                reason = "overloaded"
+                # Newest accounts leave first, only as many as the cap requires
+                accounts = accounts[:max(0, network_load[proxy_id] - cap)]
+            else:
+                reason = "proxy_unavailable"
+
+            for credentials_proxy_id in accounts:
+                target = targets.take(
+                    proxy.mobile, fallback=reason == "proxy_unavailable"
+                )
+                if target is None:
+                    unplaced += 1
+                    continue
+                moves.append(Move(
+                    credentials_proxy_id, network_id, proxy_id, target, reason
+                ))
+
+    return moves, unplaced
+
+
+def apply_moves(moves):
+    targets = {move.credentials_proxy_id: move.target for move in moves}
+    with transaction.atomic():
+        accounts = list(CredentialsProxy.objects.filter(
+            id__in=targets, status__in=MOVABLE_STATUSES,
+        ).select_for_update(skip_locked=True).only(
+            "id", "proxy_id", "status", "circuit_parked"
+        ))
+        now = timezone.now()
+        for account in accounts:
+            account.proxy_id = targets[account.id]
+            if (
+                account.status == CredentialsProxy.Status.PROXY_ERROR
+                or account.circuit_parked
+            ):
+                # The error or the open circuit was the old proxy's,
+                # nothing else would ever bring the account back
+                account.status = CredentialsProxy.Status.AVAILABLE
+                account.circuit_parked = False
+            account.status_updated = now
+        CredentialsProxy.objects.bulk_update(
+            accounts,
+            ["proxy", "status", "status_updated", "circuit_parked"],
+            batch_size=1000,
+        )
+        signals.publish_on_commit(
+            account.id for account in accounts
+            if account.status == CredentialsProxy.Status.AVAILABLE
+        )
+
+    for account in accounts:
+        logger.info(f"cred: {account.id} - MOVED TO PROXY {account.proxy_id}")
+    return len(accounts)
+
+
+def rebalance(dry_run=False, cap=None):
+    moves, unplaced = plan_moves(cap)
+    moved = 0 if dry_run else apply_moves(moves)
+    return moves, unplaced, moved
@@ -0,0 +1,120 @@
+# Queue/database reconciliation. Every message carries the ids of its
+# accounts, their publish epoch and priority in the headers. A plain shard
+# queue is FIFO and a priority queue is FIFO within a priority, so an
+# IN_QUEUE account published ahead of the head message of its queue (at a
+# higher priority, or at the same one but earlier) is no longer queued: it
+# was consumed and its status update got lost, or the message itself was
+# lost. Those accounts are returned to the pool in bulk and the loader
+# publishes them again.
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from loguru import logger
+
+from core import amqp, metrics, signals
+from core.models import CredentialsProxy, Network
+
+
+def get_shards(network):
+    if network.queue_shards <= 1:
+        return [None]
+    return list(range(network.queue_shards))
+
+
+def get_queue(network, shard, priority=False):
+    return amqp.get_queue(network.title, priority, shard)
+
+
+def find_missing(network, shard, priority, accounts, settled):
+    count, headers = amqp.inspect_queue(get_queue(network, shard, priority))
+    headers = headers or {}
+
+    # Bundled networks (ok) put several accounts in one message
+    if network.title != "ok" and count != len(accounts):
+        metrics.incr("queue_drift", abs(len(accounts) - count))
+        logger.info(
+            f"network: {network.title} shard: {shard} priority: {priority} - "
+            f"{len(accounts)} ACCOUNTS IN_QUEUE, {count} MESSAGES"
+        )
+
+    head_at, head_priority = None, 0
+    if count:
+        if headers.get("published_at") is None:
+            # Head published before the epoch headers, nothing to compare with
+            return []
+        head_at = datetime.fromtimestamp(
+            headers["published_at"], tz=dt_timezone.utc
+        )
+        head_priority = headers.get("priority") or 0
+
+    return [
+        account_id
+        for account_id, published_at, published_priority in accounts
+        if published_at < settled and (
+            head_at is None
+            or (published_priority or 0) > head_priority
+            or (published_priority or 0) == head_priority
+            and published_at < head_at
+        )
+    ]
+
+
+def reconcile_network(network):
+    now = timezone.now()
+    settled = now - timedelta(seconds=settings.RECONCILE_GRACE)
+    in_queue = CredentialsProxy.objects.filter(
+        credentials__network=network,
+        status=CredentialsProxy.Status.IN_QUEUE,
+        # Accounts published before the epoch are left to the lease
+        published_at__isnull=False,
+    ).values_list(
+        "id", "proxy_id", "proxy__ip", "published_at", "published_priority"
+    )
+
+    queued = {}
+    for account_id, proxy_id, proxy_ip, published_at, priority in in_queue:
+        # Same routing as the loaders: ok is sharded by ip, the rest by proxy
+        key = proxy_ip if network.title == "ok" else proxy_id
+        shard = amqp.get_shard(key, network.queue_shards)
+        queued.setdefault((shard, priority is not None), []).append(
+            (account_id, published_at, priority)
+        )
+
+    missing = []
+    for shard in get_shards(network):
+        for priority in (False, True):
+            missing.extend(find_missing(
+                network, shard, priority,
+                queued.get((shard, priority), []), settled,
+            ))
+    if not missing:
+        return 0
+
+    with transaction.atomic():
+        # The guard skips accounts checked out or published again meanwhile
+        reset = list(CredentialsProxy.objects.filter(
+            id__in=missing,
+            status=CredentialsProxy.Status.IN_QUEUE,
+            published_at__lt=settled,
+        ).select_for_update(skip_locked=True).values_list("id", flat=True))
+        CredentialsProxy.objects.filter(id__in=reset).update(
+            status=CredentialsProxy.Status.AVAILABLE,
+            status_updated=timezone.now(),
+            lease_expires_at=None,
+        )
+        signals.publish_on_commit(reset)
+
+    reset = len(reset)
+    metrics.incr("reconciled_accounts", reset)
+    logger.info(
+        f"network: {network.title} - RESET {reset} ACCOUNTS MISSING FROM QUEUE"
+    )
+    return reset
+
+
+def reconcile():
+    return sum(
+        reconcile_network(network) for network in Network.objects.all()
+    )
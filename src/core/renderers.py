@@ -0,0 +1,40 @@
+import orjson
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+from rest_framework.renderers import BaseRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+# Datetimes are passed back to DRF's encoder so the output format
+# (e.g. the 'Z' suffix for UTC) stays the same as with JSONRenderer.
+OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+encoder = JSONEncoder()
+
+
+class ORJSONRenderer(BaseRenderer):
+    media_type = "application/json"
+    format = "json"
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+
+        options = OPTIONS
+        renderer_context = renderer_context or {}
+        if renderer_context.get("indent") or "indent=" in (
+            accepted_media_type or ""
+        ):
+            options |= orjson.OPT_INDENT_2
+
+        return orjson.dumps(data, default=encoder.default, option=options)
+
+
+class ORJSONParser(BaseParser):
+    media_type = "application/json"
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return orjson.loads(stream.read())
+        except orjson.JSONDecodeError as exc:
+            raise ParseError(f"JSON parse error - {exc}")
@@ -1,14 +1,18 @@
-import json
 import random
 
+from django.db import transaction
 from django.utils import timezone
 from loguru import logger
+import orjson
 from rest_framework import serializers
 
 from core.models import (
     Credentials,
+    CredentialsCookies,
     CredentialsProxy,
     CredentialsStatistics,
+    CredentialsStatisticsRequest,
+    Metric,
     Proxy,
     Network,
     ParsingType,
@@ -45,12 +49,33 @@ class ProxySerializer(serializers.ModelSerializer):
     class Meta:
         model = Proxy
         fields = [
-            "id", "url", "mobile", "enable", "status", "related_accounts_count"
+            "id",
+            "url",
+            "mobile",
+            "enable",
+            "status",
+            "related_accounts_count",
+            "latency_p50",
+            "latency_p95",
+            "success_rate",
         ]
 
 
+class CookiesField(serializers.JSONField):
+    # The body is already decoded by the parser, only string-encoded jars
+    # need decoding (and no json.dumps round-trip to "validate" them).
+    def to_internal_value(self, data):
+        if isinstance(data, (str, bytes)):
+            try:
+                return orjson.loads(data)
+            except orjson.JSONDecodeError:
+                self.fail("invalid")
+        return data
+
+
 class CredentialsProxySerializer(serializers.ModelSerializer):
     credentials = CredentialsSerializer()
+    cookies = CookiesField(required=False, allow_null=True)
 
     def to_internal_value(self, data):
         data = super().to_internal_value(data)
@@ -63,9 +88,12 @@ class CredentialsProxySerializer(serializers.ModelSerializer):
             if not data.get("waiting_delta"):
                 data["waiting_delta"] = 60 * 60 * 2  # 2 hours
 
-        cookies = data.get("cookies")
-        if cookies is not None and isinstance(cookies, str):
-            data['cookies'] = json.loads(cookies)
+        if data.get("status") not in (
+            None,
+            CredentialsProxy.Status.SENT,
+            CredentialsProxy.Status.IN_QUEUE,
+        ):
+            data["lease_expires_at"] = None
 
         logger.info(
             f"cred: {self.context['view'].kwargs['pk']}"
@@ -75,6 +103,15 @@ class CredentialsProxySerializer(serializers.ModelSerializer):
 
         return data
 
+    def update(self, instance, validated_data):
+        update_cookies = "cookies" in validated_data
+        cookies = validated_data.pop("cookies", None)
+
+        instance = super().update(instance, validated_data)
+        if update_cookies:
+            CredentialsCookies.store(instance.id, cookies)
+        return instance
+
     # def update(self, instance, validated_data):
     #     proxy = validated_data.get("proxy")
     #     if proxy:
@@ -90,15 +127,9 @@ class CredentialsProxySerializer(serializers.ModelSerializer):
     def to_representation(self, instance):
         data = super().to_representation(instance)
         if instance.credentials.network.dynamic_limits:
-            parsing_types = data['credentials']['network']['types']
-            for parsing_type in parsing_types:
-                dynamic_limit = (instance.counter // 6) or 1
-                if dynamic_limit <= parsing_type["limit"]:
-                    parsing_type["limit"] = dynamic_limit
-                parsing_type["limit"] = random.randint(
-                    parsing_type["limit"]//2, parsing_type["limit"]
-                )
-            data['credentials']['network']['types'] = parsing_types
+            apply_dynamic_limits(
+                instance, data['credentials']['network']['types']
+            )
         data['limits'] = self.make_limits(
             data['credentials']['network']['types']
         )
@@ -121,6 +152,112 @@ class CredentialsProxySerializer(serializers.ModelSerializer):
         read_only_fields = ["id", "credentials"]
 
 
+def load_network_types(network_ids=None):
+    network_types = {}
+    parsing_types = ParsingType.objects.order_by("id")
+    if network_ids is not None:
+        parsing_types = parsing_types.filter(network_id__in=network_ids)
+    for parsing_type in parsing_types.values(
+        "network_id", "title", "code", "limit"
+    ):
+        network_types.setdefault(parsing_type.pop("network_id"), []).append(
+            parsing_type
+        )
+    return network_types
+
+
+def apply_dynamic_limits(instance, parsing_types):
+    planned_limits = instance.planned_limits
+    for parsing_type in parsing_types:
+        planned_limit = planned_limits.get(parsing_type["title"])
+        if planned_limit is not None:
+            parsing_type["limit"] = min(planned_limit, parsing_type["limit"])
+            continue
+
+        # No recent history for this type, see core.limits.plan_limits
+        dynamic_limit = (instance.counter // 6) or 1
+        if dynamic_limit <= parsing_type["limit"]:
+            parsing_type["limit"] = dynamic_limit
+        parsing_type["limit"] = random.randint(
+            parsing_type["limit"]//2, parsing_type["limit"]
+        )
+
+
+datetime_field = serializers.DateTimeField()
+
+
+def make_account_payload(instance, network_types):
+    # Plain-dict twin of CredentialsProxySerializer(instance).data for the
+    # hot publish/list paths, the output must stay identical.
+    credentials = instance.credentials
+    network = credentials.network
+    proxy = instance.proxy
+
+    parsing_types = [
+        dict(parsing_type)
+        for parsing_type in network_types.get(network.id, [])
+    ]
+    if network.dynamic_limits:
+        apply_dynamic_limits(instance, parsing_types)
+
+    return {
+        "id": instance.id,
+        "status": str(instance.status),
+        "status_description": instance.status_description,
+        "credentials": {
+            "id": credentials.id,
+            "network": {
+                "title": network.title,
+                "dynamic_limits": network.dynamic_limits,
+                "types": parsing_types,
+            },
+            "login": credentials.login,
+            "password": credentials.password,
+        },
+        "proxy": {
+            "id": proxy.id,
+            "url": proxy.url,
+            "mobile": proxy.mobile,
+            "enable": proxy.enable,
+            "status": str(proxy.status),
+            "related_accounts_count": None,
+            "latency_p50": proxy.latency_p50,
+            "latency_p95": proxy.latency_p95,
+            "success_rate": proxy.success_rate,
+        },
+        "start_time_of_use": datetime_field.to_representation(
+            instance.start_time_of_use
+        ),
+        "cookies": None,  # loaded at checkout, see attach_cookies
+        "token": instance.token,
+        "limits": {
+            parsing_type["title"]: parsing_type["limit"]
+            for parsing_type in parsing_types
+        },
+        "network": network.title,
+    }
+
+
+def attach_cookies(payloads):
+    cookies = CredentialsCookies.load([payload["id"] for payload in payloads])
+    for payload in payloads:
+        payload["cookies"] = cookies.get(payload["id"])
+    return payloads
+
+
+class CredentialsProxyLeaseSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = CredentialsProxy
+        fields = ["id", "status", "lease_expires_at"]
+        read_only_fields = fields
+
+
+class MetricSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Metric
+        fields = ["name", "period", "value"]
+
+
 class CredentialsStatisticsSerializer(serializers.ModelSerializer):
     def to_internal_value(self, data):
         data = super().to_internal_value(data)
@@ -134,6 +271,23 @@ class CredentialsStatisticsSerializer(serializers.ModelSerializer):
 
         return data
 
+    def create(self, validated_data):
+        # A statistics row is not kept without its per-type requests
+        with transaction.atomic():
+            instance = super().create(validated_data)
+
+            network_id = instance.credentials_proxy.credentials.network_id
+            parsing_types = dict(
+                ParsingType.objects.filter(
+                    network_id=network_id
+                ).values_list("title", "id")
+            )
+            CredentialsStatisticsRequest.objects.bulk_create(
+                CredentialsStatisticsRequest.build(instance, parsing_types)
+            )
+
+        return instance
+
     class Meta:
         model = CredentialsStatistics
         fields = [
@@ -152,3 +306,11 @@ class CredentialsStatisticsSerializer(serializers.ModelSerializer):
             "start_time_of_use": {"required": False, "allow_null": True},
             "end_time_of_use": {"required": False, "allow_null": True}
         }
+
+
+class StatisticsUsageSerializer(serializers.Serializer):
+    parsing_type_title = serializers.CharField()
+    day = serializers.DateField(required=False)
+    requests_sum = serializers.IntegerField()
+    limit_sum = serializers.IntegerField()
+    sessions = serializers.IntegerField()
@@ -0,0 +1,55 @@
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from core import tasks
+from core.models import CredentialsProxy
+
+
+def publish_on_commit(credentials_proxy_ids):
+    # Bulk updates to AVAILABLE send no post_save, their callers publish
+    # the accounts with this. ok accounts are published in bundles by
+    # load_ok_accounts_to_queue.
+    credentials_proxy_ids = list(credentials_proxy_ids)
+    if not credentials_proxy_ids:
+        return
+
+    def publish():
+        for credentials_proxy_id in CredentialsProxy.objects.filter(
+            id__in=credentials_proxy_ids,
+            status=CredentialsProxy.Status.AVAILABLE,
+            enable=True,
+        ).exclude(
+            credentials__network__title="ok"
+        ).values_list("id", flat=True):
+            tasks.publish_account.delay(credentials_proxy_id)
+
+    transaction.on_commit(publish)
+
+
+@receiver(post_save, sender=CredentialsProxy)
+def credentials_proxy_status_changed(sender, instance, **kwargs):
+    previous_status, instance._loaded_status = (
+        instance._loaded_status, instance.status
+    )
+    if previous_status == instance.status:
+        return
+
+    if (
+        instance.status == CredentialsProxy.Status.AVAILABLE
+        and instance.enable
+        # ok accounts are published in bundles by load_ok_accounts_to_queue
+        and instance.credentials.network.title != "ok"
+    ):
+        transaction.on_commit(
+            lambda: tasks.publish_account.delay(instance.id)
+        )
+
+    if instance.status in CredentialsProxy.WAITING_STATUSES:
+        transaction.on_commit(
+            lambda: tasks.schedule_account_release.delay(
+                instance.id,
+                instance.waiting_since.isoformat(),
+                instance.waiting_delta,
+            )
+        )
@@ -0,0 +1,209 @@
+# Local stand-ins for the outside world: an ip-echo service and a
+# forwarding proxy speaking HTTP (CONNECT and absolute-form requests) and
+# SOCKS5 on the same port for the proxy health check, used by the
+# run_standins command, and a Telegram Bot API for notifications.
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+import selectors
+import socket
+import socketserver
+import struct
+import threading
+import time
+from urllib.parse import urlsplit
+
+from core.utils import receive
+
+
+class IPEchoHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = self.client_address[0].encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeProxyHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        server = self.server
+        if server.fail_rate and random.random() < server.fail_rate:
+            return
+        if server.delay:
+            time.sleep(server.delay)
+
+        self.request.settimeout(30)
+        try:
+            first = self.request.recv(1, socket.MSG_PEEK)
+            if first == b"\x05":
+                upstream = self.handle_socks()
+            else:
+                upstream = self.handle_http()
+        except (OSError, ValueError):
+            # tcp and socks checks hang up right after the handshake
+            return
+        if upstream:
+            with upstream:
+                pipe(self.request, upstream)
+
+    def handle_socks(self):
+        _, count = struct.unpack("BB", receive(self.request, 2))
+        methods = receive(self.request, count)
+        method = 2 if self.server.login else 0
+        if method not in methods:
+            self.request.sendall(b"\x05\xff")
+            return None
+        self.request.sendall(bytes([5, method]))
+
+        if method == 2:
+            _, size = struct.unpack("BB", receive(self.request, 2))
+            login = receive(self.request, size).decode()
+            size = receive(self.request, 1)[0]
+            password = receive(self.request, size).decode()
+            if (login, password) != (self.server.login, self.server.password):
+                self.request.sendall(b"\x01\x01")
+                return None
+            self.request.sendall(b"\x01\x00")
+
+        _, command, _, address_type = struct.unpack("BBBB", receive(self.request, 4))
+        if address_type == 1:
+            host = socket.inet_ntoa(receive(self.request, 4))
+        elif address_type == 3:
+            host = receive(self.request, receive(self.request, 1)[0]).decode()
+        else:
+            host = socket.inet_ntop(socket.AF_INET6, receive(self.request, 16))
+        port = struct.unpack(">H", receive(self.request, 2))[0]
+
+        if command != 1:
+            self.request.sendall(b"\x05\x07\x00\x01" + b"\x00" * 6)
+            return None
+        try:
+            upstream = socket.create_connection((host, port), timeout=30)
+        except OSError:
+            self.request.sendall(b"\x05\x05\x00\x01" + b"\x00" * 6)
+            return None
+        self.request.sendall(b"\x05\x00\x00\x01" + b"\x00" * 6)
+        return upstream
+
+    def handle_http(self):
+        head = b""
+        while b"\r\n\r\n" not in head:
+            chunk = self.request.recv(4096)
+            if not chunk:
+                return None
+            head += chunk
+        head, rest = head.split(b"\r\n\r\n", 1)
+        request_line, *headers = head.decode("latin-1").split("\r\n")
+        method, target, version = request_line.split(" ", 2)
+
+        if method == "CONNECT":
+            host, port = target.rsplit(":", 1)
+            upstream = socket.create_connection((host, int(port)), timeout=30)
+            self.request.sendall(b"HTTP/1.1 200 Connection established\r\n\r\n")
+            if rest:
+                upstream.sendall(rest)
+            return upstream
+
+        url = urlsplit(target)
+        upstream = socket.create_connection(
+            (url.hostname, url.port or 80), timeout=30
+        )
+        path = url.path or "/"
+        if url.query:
+            path = f"{path}?{url.query}"
+        headers = [
+            header for header in headers
+            if not header.lower().startswith(("proxy-", "connection:"))
+        ]
+        upstream.sendall("\r\n".join(
+            [f"{method} {path} {version}", *headers, "Connection: close", "", ""]
+        ).encode("latin-1") + rest)
+        return upstream
+
+
+def pipe(client, upstream):
+    selector = selectors.DefaultSelector()
+    selector.register(client, selectors.EVENT_READ, upstream)
+    selector.register(upstream, selectors.EVENT_READ, client)
+    try:
+        while events := selector.select(timeout=30):
+            for key, _ in events:
+                data = key.fileobj.recv(65536)
+                if not data:
+                    return
+                key.data.sendall(data)
+    except OSError:
+        return
+    finally:
+        selector.close()
+
+
+class FakeProxy(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, delay=0, fail_rate=0, login=None, password=None):
+        super().__init__(address, FakeProxyHandler)
+        self.delay = delay
+        self.fail_rate = fail_rate
+        self.login = login
+        self.password = password
+
+
+class IPEchoServer(ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address):
+        super().__init__(address, IPEchoHandler)
+
+
+class TelegramHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            failed = server.requests in server.fail_requests
+            if not failed:
+                server.messages.append(json.loads(body))
+
+        status = 500 if failed else 200
+        response = json.dumps({"ok": not failed}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TelegramStandIn(ThreadingHTTPServer):
+    # Set TELEGRAM_API_URL to its url. Delivered messages are kept in
+    # messages, requests listed in fail_requests (counted from 1) fail.
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, fail_requests=()):
+        super().__init__(address, TelegramHandler)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.fail_requests = set(fail_requests)
+        self.messages = []
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+def serve_in_thread(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -1,123 +1,297 @@
+from datetime import datetime, timedelta
+from itertools import groupby, zip_longest
 import json
+import math
 from typing import Union
+import uuid
 
-from django.db.models import F, Q
+from django.conf import settings
+from django.db import transaction
+from django.db.models import (
+    Count, DurationField, ExpressionWrapper, F, OuterRef, Q, Subquery,
+)
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 from loguru import logger
+from requests import RequestException
 
 from conf.celery import app
-from core import amqp
+from core import (
+    amqp, analytics, circuit, limits, metrics, notifications, rebalancer,
+    reconcile, signals,
+)
+from core.locks import skip_if_running
 from core.models import (
-    CredentialsProxy, Proxy, CredentialsStatistics, ProxyCounter,
+    CredentialsProxy,
+    Notification,
+    Proxy,
+    ProxyCheck,
+    CredentialsStatistics,
+    ProxyCounter,
+    ProxyRent,
 )
-from core.serializers import CredentialsProxySerializer
+from core.serializers import load_network_types, make_account_payload
 
 
 @app.task
-def update_account_status(credentials_proxy_id, status):
-    credentials_proxy = CredentialsProxy.objects.select_related(
-        "credentials__network"
-    ).get(
-        id=credentials_proxy_id
+def record_checkout(credentials_proxy_ids):
+    # Status, lease and token were set by the checkout itself. Only the
+    # usage counters are left, as F() updates, so a status the worker
+    # reported in the meantime is not overwritten.
+    now = timezone.now()
+    CredentialsProxy.objects.filter(id__in=credentials_proxy_ids).update(
+        counter=F("counter") + 1,
+        time_of_sent=now,
+        start_time_of_use=now,
     )
-    credentials_proxy.status = status
-    credentials_proxy.time_of_sent = timezone.now()
-    credentials_proxy.counter += 1
-    credentials_proxy.start_time_of_use = timezone.now()
-    credentials_proxy.status_updated = timezone.now()
-    credentials_proxy.save()
-    proxy_counter, _ = ProxyCounter.objects.get_or_create(
-        network=credentials_proxy.credentials.network,
-        proxy=credentials_proxy.proxy,
+    for network_id, proxy_id, count in CredentialsProxy.objects.filter(
+        id__in=credentials_proxy_ids
+    ).values_list("credentials__network_id", "proxy_id").annotate(
+        count=Count("id")
+    ).order_by():
+        proxy_counter, _ = ProxyCounter.objects.get_or_create(
+            network_id=network_id, proxy_id=proxy_id
+        )
+        ProxyCounter.objects.filter(id=proxy_counter.id).update(
+            counter=F("counter") + count
+        )
+    for credentials_proxy_id in credentials_proxy_ids:
+        logger.info(f"cred: {credentials_proxy_id} - CHANGED STATUS TO 'SENT'")
+
+
+def get_lease_deadline(lease):
+    return timezone.now() + timedelta(seconds=lease)
+
+
+def claim_account(credentials_proxy_id, priority=None):
+    now = timezone.now()
+    claim = {
+        "status": CredentialsProxy.Status.IN_QUEUE,
+        "status_updated": now,
+        "lease_expires_at": get_lease_deadline(settings.QUEUE_LEASE),
+        "published_at": now,
+        "published_priority": priority,
+        "publish_token": uuid.uuid4(),
+    }
+    claimed = CredentialsProxy.objects.filter(
+        id=credentials_proxy_id,
+        status=CredentialsProxy.Status.AVAILABLE,
+        enable=True,
+        proxy__enable=True,
+    ).exclude(
+        credentials__network__title="ok"
+    ).within_proxy_limit().update(**claim)
+    if not claimed:
+        return None
+    logger.info(
+        f"cred: {credentials_proxy_id} - CHANGED STATUS TO 'IN_QUEUE'"
+    )
+    return claim
+
+
+def checkout_accounts(account_ids, publish_token):
+    # One conditional update: only the message published last for an
+    # account finds it IN_QUEUE with its token. The token is replaced, so a
+    # redelivered copy of the same message can't claim the account again.
+    checkout_token = uuid.uuid4()
+    claimed = CredentialsProxy.objects.filter(
+        id__in=account_ids,
+        publish_token=publish_token,
+        status=CredentialsProxy.Status.IN_QUEUE,
+    ).update(
+        status=CredentialsProxy.Status.SENT,
+        status_updated=timezone.now(),
+        lease_expires_at=get_lease_deadline(settings.CHECKOUT_LEASE),
+        publish_token=checkout_token,
+    )
+    if claimed == len(account_ids):
+        return list(account_ids)
+    if not claimed:
+        return []
+    return list(CredentialsProxy.objects.filter(
+        id__in=account_ids, publish_token=checkout_token
+    ).values_list("id", flat=True))
+
+
+def get_priority(credentials_proxy):
+    if not credentials_proxy.credentials.network.priority_delivery:
+        return None
+    return max(0, amqp.MAX_PRIORITY - credentials_proxy.health_penalty)
+
+
+def send_account_to_queue(credentials_proxy, network_types):
+    network = credentials_proxy.credentials.network
+    amqp.publish(
+        network.title,
+        make_account_payload(credentials_proxy, network_types),
+        priority=credentials_proxy.published_priority,
+        codec=network.message_codec,
+        shard=amqp.get_shard(credentials_proxy.proxy_id, network.queue_shards),
+        headers=amqp.make_headers(
+            [credentials_proxy.id],
+            credentials_proxy.published_at,
+            credentials_proxy.publish_token,
+            credentials_proxy.published_priority,
+        ),
     )
-    proxy_counter.counter += 1
-    proxy_counter.save()
     logger.info(
-        f"cred: {credentials_proxy_id} - CHANGED STATUS TO '{status}'"
+        f"cred: {credentials_proxy.id} "
+        f"- SEND ACCOUNT TO QUEUE "
+        f"({credentials_proxy.credentials.network.title})"
     )
 
 
+@app.task
+def publish_account(credentials_proxy_id):
+    credentials_proxy = CredentialsProxy.objects.select_related(
+        "credentials",
+        "credentials__network",
+        "proxy",
+        "limit_plan",
+    ).with_health_penalty().filter(id=credentials_proxy_id).first()
+    if credentials_proxy is None:
+        return
+
+    claim = claim_account(
+        credentials_proxy_id, get_priority(credentials_proxy)
+    )
+    if not claim:
+        return
+    for field, value in claim.items():
+        setattr(credentials_proxy, field, value)
+    send_account_to_queue(
+        credentials_proxy,
+        load_network_types([credentials_proxy.credentials.network_id]),
+    )
+
+
+def interleave_by_proxy(credentials_proxies):
+    # Round-robin over (network, proxy) groups, alternating mobile and
+    # regular proxies, so consecutive messages of a queue use different
+    # proxies.
+    groups = {}
+    for credentials_proxy in credentials_proxies:
+        groups.setdefault(
+            (credentials_proxy.credentials.network_id, credentials_proxy.proxy_id),
+            [],
+        ).append(credentials_proxy)
+
+    mobile = [group for group in groups.values() if group[0].proxy.mobile]
+    regular = [group for group in groups.values() if not group[0].proxy.mobile]
+    ordered = [
+        group for pair in zip_longest(mobile, regular) for group in pair if group
+    ]
+    for accounts in zip_longest(*ordered):
+        for credentials_proxy in accounts:
+            if credentials_proxy is not None:
+                yield credentials_proxy
+
+
 @app.task(name="load_accounts_to_queue")
+@skip_if_running
 def load_accounts_to_queue(**kwargs):
     credentials_proxies = CredentialsProxy.objects.filter(
         status=CredentialsProxy.Status.AVAILABLE,
         enable=True,
+        proxy__enable=True,
     ).exclude(
         credentials__network__title="ok"
     ).select_related(
         "credentials",
         "credentials__network",
         "proxy",
-    )
+        "limit_plan",
+    ).with_health_penalty()
+    network_types = load_network_types()
 
-    for credentials_proxy in credentials_proxies:
-        # if (
-        #     credentials_proxy.credentials.network.title == "facebook"
-        #     and (not credentials_proxy.proxy.mobile)
-        # ):
-        #     credentials_proxy_count = CredentialsProxy.objects.filter(
-        #         credentials__network=credentials_proxy.credentials.network,
-        #         proxy=credentials_proxy.proxy
-        #     ).filter(
-        #         Q(status=CredentialsProxy.Status.SENT) |
-        #         Q(status=CredentialsProxy.Status.IN_QUEUE)
-        #     ).count()
-        #     try:
-        #         proxy_counter, _ = ProxyCounter.objects.get_or_create(
-        #             network=credentials_proxy.credentials.network,
-        #             proxy=credentials_proxy.proxy,
-        #         )
-        #     except Exception:
-        #         proxy_counter, _ = ProxyCounter.objects.get(
-        #             network=credentials_proxy.credentials.network,
-        #             proxy=credentials_proxy.proxy,
-        #         )
-        #     if credentials_proxy_count > proxy_counter.counter // 10:
-        #         continue
-
-        credentials_proxy.status = CredentialsProxy.Status.IN_QUEUE
-        credentials_proxy.save()
-        logger.info(
-            f"cred: {credentials_proxy.id} - CHANGED STATUS TO 'IN_QUEUE'"
-        )
-        amqp.publish(
-            credentials_proxy.credentials.network.title,
-            CredentialsProxySerializer(credentials_proxy).data,
-        )
-        logger.info(
-            f"cred: {credentials_proxy.id} "
-            f"- SEND ACCOUNT TO QUEUE "
-            f"({credentials_proxy.credentials.network.title})"
+    in_flight = {
+        (row["credentials__network_id"], row["proxy_id"]): row["count"]
+        for row in CredentialsProxy.objects.filter(
+            status__in=CredentialsProxy.IN_FLIGHT_STATUSES,
+        ).values("credentials__network_id", "proxy_id").annotate(
+            count=Count("id")
+        ).order_by()
+    }
+
+    for credentials_proxy in interleave_by_proxy(credentials_proxies):
+        network = credentials_proxy.credentials.network
+        key = (network.id, credentials_proxy.proxy_id)
+        if (
+            network.max_accounts_per_proxy is not None
+            and in_flight.get(key, 0) >= network.max_accounts_per_proxy
+        ):
+            continue
+
+        claim = claim_account(
+            credentials_proxy.id, get_priority(credentials_proxy)
         )
+        if claim:
+            in_flight[key] = in_flight.get(key, 0) + 1
+            for field, value in claim.items():
+                setattr(credentials_proxy, field, value)
+            send_account_to_queue(credentials_proxy, network_types)
 
 
 @app.task(name="load_ok_accounts_to_queue")
+@skip_if_running
 def load_ok_accounts_to_queue(**kwargs):
-    proxies = CredentialsProxy.objects.filter(
-        status=CredentialsProxy.Status.AVAILABLE,
-        credentials__network__title="ok",
-        enable=True,
-    ).values_list("proxy__ip", flat=True)
-
-    for proxy_ip in set(proxies):
-        credentials_proxy = CredentialsProxy.objects.filter(
-            proxy__ip=proxy_ip,
-            credentials__network__title="ok",
+    with transaction.atomic():
+        credentials_proxies = list(CredentialsProxy.objects.filter(
             status=CredentialsProxy.Status.AVAILABLE,
-        ).select_related("credentials", "credentials__network")
+            credentials__network__title="ok",
+            enable=True,
+            proxy__enable=True,
+        ).select_related(
+            "credentials",
+            "credentials__network",
+            "proxy",
+            "limit_plan",
+        ).select_for_update(
+            skip_locked=True, of=("self",)
+        ).order_by("proxy__ip", "id"))
 
-        data = CredentialsProxySerializer(credentials_proxy, many=True).data
-        credentials_proxy.update(status=CredentialsProxy.Status.IN_QUEUE)
+        # Rows are locked, the status guard only protects against
+        # concurrent writers that do not take row locks.
+        published_at = timezone.now()
+        # One token for the run, every bundle is published once
+        publish_token = uuid.uuid4()
+        CredentialsProxy.objects.filter(
+            id__in=[account.id for account in credentials_proxies],
+            status=CredentialsProxy.Status.AVAILABLE,
+        ).update(
+            status=CredentialsProxy.Status.IN_QUEUE,
+            status_updated=published_at,
+            lease_expires_at=get_lease_deadline(settings.QUEUE_LEASE),
+            published_at=published_at,
+            published_priority=None,
+            publish_token=publish_token,
+        )
 
-        for account in credentials_proxy:
+    network_types = load_network_types({
+        account.credentials.network_id for account in credentials_proxies
+    })
+    for proxy_ip, accounts in groupby(
+        credentials_proxies, key=lambda account: account.proxy.ip
+    ):
+        accounts = list(accounts)
+        for account in accounts:
             logger.info(f"cred: {account.id} - CHANGED STATUS TO 'IN_QUEUE'")
 
-        amqp.publish("ok", data)
-        for account in credentials_proxy:
+        network = accounts[0].credentials.network
+        amqp.publish("ok", [
+            make_account_payload(account, network_types)
+            for account in accounts
+        ], codec=network.message_codec, shard=amqp.get_shard(
+            proxy_ip, network.queue_shards
+        ), headers=amqp.make_headers(
+            [account.id for account in accounts], published_at, publish_token
+        ))
+        for account in accounts:
             logger.info(f"cred: {account.id} - SEND ACCOUNT TO QUEUE (ok)")
 
 
 @app.task(name="update_proxy_statuses")
+@skip_if_running
 def update_proxy_statuses(**kwargs):
     proxies = Proxy.objects.filter(enable=True)
     if kwargs.get('all'):
@@ -126,19 +300,253 @@ def update_proxy_statuses(**kwargs):
     for proxy in proxies:
         proxy.update_status()
 
+    summarized = ProxyCheck.summarize()
+    logger.info(f"SUMMARIZED CHECKS OF {summarized} PROXIES")
+
+
+@app.task(name="recheck_proxy")
+def recheck_proxy(proxy_id, attempt=0):
+    proxy = Proxy.objects.filter(id=proxy_id, circuit=Proxy.Circuit.OPEN).first()
+    if not proxy:
+        return
+
+    proxy.update_status()
+    if proxy.status == Proxy.Status.AVAILABLE:
+        circuit.half_open(proxy)
+        return
+
+    recheck_proxy.apply_async(
+        (proxy_id, attempt + 1),
+        countdown=min(settings.CIRCUIT_RECHECK_DELAY * 2 ** (attempt + 1), 60 * 60),
+    )
+    logger.info(f"proxy: {proxy_id} - RECHECK FAILED ({proxy.status})")
+
+
+@app.task(name="close_circuit")
+def close_circuit(proxy_id, circuit_changed):
+    circuit.close(proxy_id, datetime.fromisoformat(circuit_changed))
+
+
+@app.task
+def schedule_account_release(credentials_proxy_id, waiting_since, delay):
+    delay = amqp.publish_delayed(delay, {
+        "credentials_proxy_id": credentials_proxy_id,
+        "waiting_since": waiting_since,
+    })
+    logger.info(
+        f"cred: {credentials_proxy_id} - RELEASE SCHEDULED IN {delay}s"
+    )
+
+
+@app.task
+def release_account(credentials_proxy_id, waiting_since):
+    # Another waiting_since means the account left the wait and came back
+    # after the release was scheduled, its own release message is pending.
+    credentials_proxy = CredentialsProxy.objects.filter(
+        id=credentials_proxy_id,
+        status__in=CredentialsProxy.WAITING_STATUSES,
+        waiting_since=datetime.fromisoformat(waiting_since),
+    ).select_related("credentials__network").first()
+    if not credentials_proxy:
+        return
+
+    # The delay was rounded down to a bucket, wait out the rest
+    remaining = math.ceil((
+        credentials_proxy.waiting_since
+        + timedelta(seconds=credentials_proxy.waiting_delta)
+        - timezone.now()
+    ).total_seconds())
+    if remaining > 0:
+        schedule_account_release(credentials_proxy.id, waiting_since, remaining)
+        return
+
+    credentials_proxy.status = CredentialsProxy.Status.AVAILABLE
+    credentials_proxy.save()
+    logger.info(
+        f"cred: {credentials_proxy.id} - CHANGE STATUS TO 'AVAILABLE'"
+    )
+
+
+@app.task(name="check_proxy_rents")
+@skip_if_running
+def check_proxy_rents(**kwargs):
+    today = timezone.localdate()
+    tomorrow = today + timedelta(days=1)
+
+    with transaction.atomic():
+        rents = list(ProxyRent.objects.filter(
+            Q(expiration_date=tomorrow, tomorrow_notification=False) |
+            Q(expiration_date=today, today_notification=False),
+            id=Subquery(
+                ProxyRent.objects.filter(
+                    proxy=OuterRef("proxy")
+                ).order_by("-id").values("id")[:1]
+            ),
+            proxy__enable=True,
+        ).select_related("proxy").select_for_update(of=("self",)))
+
+        Notification.objects.bulk_create([
+            Notification(
+                kind=(
+                    Notification.Kind.RENT_EXPIRES_TODAY
+                    if rent.expiration_date == today
+                    else Notification.Kind.RENT_EXPIRES_TOMORROW
+                ),
+                subject=rent.proxy.ip,
+            )
+            for rent in rents
+        ])
+        ProxyRent.objects.filter(
+            id__in=[
+                rent.id for rent in rents if rent.expiration_date == tomorrow
+            ]
+        ).update(tomorrow_notification=True)
+        ProxyRent.objects.filter(
+            id__in=[
+                rent.id for rent in rents if rent.expiration_date == today
+            ]
+        ).update(today_notification=True)
+
+    logger.info(f"FOUND {len(rents)} EXPIRING PROXY RENTS")
+
 
 @app.task(name="update_credentials_proxy_statuses")
+@skip_if_running
 def update_credentials_proxy_statuses(**kwargs):
-    credentials_proxies = CredentialsProxy.objects.filter(
-        Q(status=CredentialsProxy.Status.WAITING) |
-        Q(status=CredentialsProxy.Status.TEMPORARILY_BANNED)
-    )
+    # Only accounts whose release message is overdue by RELEASE_GRACE
+    released_before = timezone.now() - timedelta(seconds=settings.RELEASE_GRACE)
+    credentials_proxies = CredentialsProxy.objects.alias(
+        released_at=Coalesce("waiting_since", "status_updated")
+        + ExpressionWrapper(
+            F("waiting_delta") * timedelta(seconds=1),
+            output_field=DurationField(),
+        ),
+    ).filter(
+        status__in=CredentialsProxy.WAITING_STATUSES,
+        released_at__lt=released_before,
+        # Parked accounts wait for their proxy, see core.circuit
+        circuit_parked=False,
+    ).select_related("credentials__network")
     for credentials_proxy in credentials_proxies:
-        if (
-            timezone.now() - credentials_proxy.status_updated
-        ).total_seconds() > credentials_proxy.waiting_delta:
-            credentials_proxy.status = CredentialsProxy.Status.AVAILABLE
-            credentials_proxy.save()
-            logger.info(
-                f"cred: {credentials_proxy.id} - CHANGE STATUS TO 'AVAILABLE'"
+        credentials_proxy.status = CredentialsProxy.Status.AVAILABLE
+        credentials_proxy.save()
+        logger.info(
+            f"cred: {credentials_proxy.id} - CHANGE STATUS TO 'AVAILABLE'"
+        )
+
+
+@app.task(name="reclaim_expired_leases")
+@skip_if_running
+def reclaim_expired_leases(**kwargs):
+    with transaction.atomic():
+        expired = list(CredentialsProxy.objects.filter(
+            status__in=[
+                CredentialsProxy.Status.SENT, CredentialsProxy.Status.IN_QUEUE
+            ],
+            lease_expires_at__lt=timezone.now(),
+        ).select_for_update(skip_locked=True).values_list("id", "status"))
+        CredentialsProxy.objects.filter(
+            id__in=[credentials_proxy_id for credentials_proxy_id, _ in expired]
+        ).update(
+            status=CredentialsProxy.Status.AVAILABLE,
+            status_updated=timezone.now(),
+            lease_expires_at=None,
+        )
+        signals.publish_on_commit(
+            credentials_proxy_id for credentials_proxy_id, _ in expired
+        )
+
+    for credentials_proxy_id, status in expired:
+        logger.info(
+            f"cred: {credentials_proxy_id} - {status.upper()} LEASE EXPIRED, "
+            f"CHANGED STATUS TO 'AVAILABLE'"
+        )
+    for status, group in groupby(sorted(status for _, status in expired)):
+        metrics.incr(f"reclaimed_leases_{status}", len(list(group)))
+    logger.info(f"RECLAIMED {len(expired)} ACCOUNTS WITH EXPIRED LEASE")
+
+
+@app.task(name="reconcile_queues")
+@skip_if_running
+def reconcile_queues(**kwargs):
+    reset = reconcile.reconcile()
+    logger.info(f"RECONCILED QUEUES, {reset} ACCOUNTS RESET")
+
+
+@app.task(name="send_notifications")
+@skip_if_running
+def send_notifications(**kwargs):
+    # Claimed in a short transaction and sent outside of it: next_attempt
+    # is moved past the time the sending may take, so no row lock is held
+    # while waiting on Telegram and rows of a crashed run come back later.
+    with transaction.atomic():
+        pending = list(Notification.objects.filter(
+            sent__isnull=True,
+            next_attempt__lte=timezone.now(),
+        ).select_for_update(skip_locked=True).order_by("id"))
+        if not pending:
+            return
+
+        batches = notifications.split_digest(pending)
+        Notification.objects.filter(
+            id__in=[notification.id for notification in pending]
+        ).update(next_attempt=timezone.now() + timedelta(
+            seconds=settings.TELEGRAM_TIMEOUT * (len(batches) + 1)
+        ))
+
+    sent = 0
+    for i, batch in enumerate(batches):
+        try:
+            notifications.send_telegram_message(
+                notifications.make_digest(batch)
+            )
+        except RequestException as e:
+            failed = [
+                notification
+                for unsent in batches[i:]
+                for notification in unsent
+            ]
+            for notification in failed:
+                notification.attempts += 1
+                notification.next_attempt = timezone.now() + timedelta(
+                    minutes=min(2 ** notification.attempts, 60)
+                )
+            Notification.objects.bulk_update(
+                failed, ["attempts", "next_attempt"]
+            )
+            logger.warning(
+                f"Failed to send {len(failed)} notifications: {e}"
             )
+            break
+
+        Notification.objects.filter(
+            id__in=[notification.id for notification in batch]
+        ).update(sent=timezone.now())
+        sent += len(batch)
+
+    logger.info(f"SENT {sent} NOTIFICATIONS")
+
+
+@app.task(name="plan_limits")
+@skip_if_running
+def plan_limits(**kwargs):
+    planned = limits.plan_limits()
+    logger.info(f"PLANNED LIMITS FOR {planned} ACCOUNTS")
+
+
+@app.task(name="rebalance_accounts")
+@skip_if_running
+def rebalance_accounts(**kwargs):
+    moves, unplaced, moved = rebalancer.rebalance()
+    metrics.incr("rebalanced_accounts", moved)
+    logger.info(
+        f"REBALANCED {moved} OF {len(moves)} PLANNED MOVES, {unplaced} UNPLACED"
+    )
+
+
+@app.task(name="build_statistics_report")
+@skip_if_running
+def build_statistics_report(**kwargs):
+    report = analytics.build_report()
+    analytics.write_report(report)
+    logger.info(f"BUILT STATISTICS REPORT FOR {report['total']['sessions']} SESSIONS")
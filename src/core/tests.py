@@ -1,3 +1,1296 @@
-from django.test import TestCase
+from contextlib import contextmanager
+from datetime import timedelta
+from decimal import Decimal
+from functools import partial
+import gzip
+import io
+import json
+import socket
+import threading
+from unittest import mock, skipUnless
+import uuid
 
-# Create your tests here.
+import brotli
+from celery import Celery
+from celery.contrib.testing.worker import start_worker
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import DatabaseError, connection, connections
+from django.db.models import Count, QuerySet
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+import numpy as np
+from rest_framework.exceptions import ParseError
+from rest_framework.renderers import JSONRenderer
+
+from core import (
+    amqp, analytics, circuit, limits, locks, notifications, rebalancer,
+    reconcile, standins, tasks, utils,
+)
+from core.models import (
+    Credentials,
+    CredentialsCookies,
+    CredentialsLimits,
+    CredentialsProxy,
+    CredentialsStatistics,
+    CredentialsStatisticsRequest,
+    Metric,
+    Network,
+    Notification,
+    ParsingType,
+    Proxy,
+    ProxyCheck,
+    ProxyCounter,
+    ProxyRent,
+)
+from core.renderers import ORJSONParser, ORJSONRenderer
+from core.serializers import (
+    CredentialsProxySerializer, load_network_types, make_account_payload,
+)
+
+
+def create_account(network, login, proxy=None, status=CredentialsProxy.Status.SENT):
+    # Created as SENT, so the post_save signal does not publish the account
+    proxy = proxy or Proxy.objects.create(ip=f"10.0.0.{login}", port="8000")
+    credentials = Credentials.objects.create(
+        network=network, login=login, password="password"
+    )
+    return CredentialsProxy.objects.create(
+        credentials=credentials, proxy=proxy, status=status
+    )
+
+
+def create_statistics(credentials_proxy, result_status, request_count):
+    now = timezone.now()
+    statistics = CredentialsStatistics.objects.create(
+        credentials_proxy=credentials_proxy,
+        proxy=credentials_proxy.proxy,
+        start_time_of_use=now,
+        end_time_of_use=now,
+        result_status=result_status,
+        request_count=request_count,
+    )
+    CredentialsStatisticsRequest.objects.bulk_create(
+        CredentialsStatisticsRequest.build(statistics, dict(
+            statistics.credentials_proxy.credentials.network.types.values_list(
+                "title", "id"
+            )
+        ))
+    )
+    return statistics
+
+
+class PlanLimitsTest(TestCase):
+    def setUp(self):
+        self.network = Network.objects.create(title="vk", dynamic_limits=True)
+        ParsingType.objects.create(network=self.network, title="posts", limit=100)
+
+    def test_plans_from_outcomes(self):
+        account = create_account(self.network, "1")
+        create_statistics(account, CredentialsStatistics.Status.WAITING, {"posts": 40})
+        create_statistics(account, CredentialsStatistics.Status.BANNED, {"posts": 50})
+
+        self.assertEqual(limits.plan_limits(), 1)
+        self.assertEqual(
+            CredentialsLimits.objects.get(credentials_proxy=account).limits,
+            {"posts": 40},
+        )
+
+    def test_skips_statistics_of_deleted_accounts(self):
+        account = create_account(self.network, "1")
+        deleted = create_account(self.network, "2")
+        create_statistics(account, CredentialsStatistics.Status.WAITING, {"posts": 40})
+        create_statistics(deleted, CredentialsStatistics.Status.WAITING, {"posts": 40})
+        deleted.delete()
+
+        self.assertEqual(limits.plan_limits(), 1)
+        self.assertQuerysetEqual(
+            CredentialsLimits.objects.values_list("credentials_proxy_id", flat=True),
+            [account.id],
+        )
+
+
+class YieldTest(SimpleTestCase):
+    def test_requests_add_up_per_account_until_the_ban(self):
+        accounts = np.array([0, 0, 1, 1, 2, 3, 3, 3])
+        requests = np.array([7, 8, 10, 25, 50, 5, 5, 95])
+        banned = np.array([False, True, False, True, False, True, False, False])
+
+        totals, ended = analytics.get_lifetimes(accounts, requests, banned)
+        self.assertEqual(totals.tolist(), [7, 8, 35, 50, 5, 100])
+        self.assertEqual(
+            ended.tolist(), [False, True, True, False, True, False]
+        )
+
+        # Deleted accounts left out: bans at 5 and 35, 50 and 100 censored
+        self.assertEqual(
+            analytics.get_yield(accounts[2:], requests[2:], banned[2:]),
+            {
+                "accounts": 4,
+                "censored": 2,
+                "mean": 60.0,
+                "p10": 5.0,
+                "p50": 35.0,
+                "p90": None,
+            },
+        )
+        self.assertIsNone(analytics.get_yield(*(np.array([], int),) * 3))
+
+class AdminQueryCountTest(TestCase):
+    # Query counts per page must not grow with the number of rows shown
+    @classmethod
+    def setUpTestData(cls):
+        network = Network.objects.create(title="vk")
+        for i in range(30):
+            account = create_account(network, str(i))
+            for _ in range(30):
+                create_statistics(account, CredentialsStatistics.Status.WAITING, None)
+        cls.account = account
+
+    def setUp(self):
+        self.client.force_login(
+            User.objects.create_superuser("admin", "admin@example.com", "admin")
+        )
+
+    def assertColumns(self, url, count, table, loaded, deferred):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(queries), count)
+        rows = next(
+            query["sql"] for query in queries
+            if query["sql"].startswith(f'SELECT "{table}"."id"')
+        )
+        for column in loaded:
+            self.assertIn(f'"{table}"."{column}"', rows)
+        for column in deferred:
+            self.assertNotIn(f'"{table}"."{column}"', rows)
+
+    def test_credentials_proxy_changelist(self):
+        self.assertColumns(
+            "/admin/core/credentialsproxy/", 5, "core_credentialsproxy",
+            loaded=["status", "enable", "waiting_delta"],
+            deferred=["status_description", "token", "publish_token"],
+        )
+
+    def test_statistics_changelist(self):
+        self.assertColumns(
+            "/admin/core/credentialsstatistics/", 4, "core_credentialsstatistics",
+            loaded=["request_count", "limit", "result_status"],
+            deferred=["status_description", "credentials_proxy_id"],
+        )
+
+    def test_credentials_proxy_changelist_edit(self):
+        response = self.client.post("/admin/core/credentialsproxy/", {
+            "form-TOTAL_FORMS": 1,
+            "form-INITIAL_FORMS": 1,
+            "form-0-id": self.account.id,
+            "form-0-status": CredentialsProxy.Status.WAITING,
+            "form-0-enable": "on",
+            "_save": "Сохранить",
+        })
+        self.assertEqual(response.status_code, 302)
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.status, CredentialsProxy.Status.WAITING)
+        self.assertIsNotNone(self.account.waiting_since)
+
+    def test_credentials_proxy_change_page(self):
+        # 12 queries of a live request: the change view's BEGIN becomes a
+        # savepoint pair inside a test case, one query more
+        with self.assertNumQueries(13):
+            response = self.client.get(
+                f"/admin/core/credentialsproxy/{self.account.id}/change/"
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.content.decode().count("field-result_status"), 20
+        )
+
+
+def make_worker_app():
+    # The project's routes on an in-memory broker. Only the routes are
+    # taken from the settings: a namespaced CELERY_BROKER_URL would win over
+    # any broker given here. Stand-ins are registered under the names of
+    # real hot, sweeps and io tasks, eagerly and unshared so the real tasks
+    # do not replace them on finalize.
+    worker_app = Celery(
+        "credentials_manager_test",
+        broker="memory://",
+        backend="cache+memory://",
+        set_as_current=False,
+    )
+    worker_app.conf.task_routes = settings.CELERY_TASK_ROUTES
+    return worker_app
+
+
+class TaskQueuesTest(SimpleTestCase):
+    def test_hot_tasks_are_not_starved_by_sweeps(self):
+        worker_app = make_worker_app()
+        self.assertEqual(worker_app.conf.broker_url, "memory://")
+
+        started = {"sweeps": threading.Event(), "io": threading.Event()}
+        finished = {"sweeps": threading.Event(), "io": threading.Event()}
+        release = threading.Event()
+        register = partial(worker_app.task, shared=False, lazy=False)
+
+        @register(name="reclaim_expired_leases")
+        def sweep():
+            started["sweeps"].set()
+            release.wait(30)
+            finished["sweeps"].set()
+
+        @register(name="update_proxy_statuses")
+        def check():
+            started["io"].set()
+            release.wait(30)
+            finished["io"].set()
+
+        @register(name="core.tasks.record_checkout")
+        def hot(credentials_proxy_ids):
+            # Which slow workers were busy while the hot task ran
+            return sorted(
+                queue for queue in started
+                if started[queue].is_set() and not finished[queue].is_set()
+            )
+
+        workers = [
+            start_worker(
+                worker_app, queues=[queue], perform_ping_check=False
+            )
+            for queue in ("hot", "sweeps", "io")
+        ]
+        for worker in workers:
+            worker.__enter__()
+        try:
+            worker_app.send_task("reclaim_expired_leases")
+            worker_app.send_task("update_proxy_statuses")
+            self.assertTrue(started["sweeps"].wait(10))
+            self.assertTrue(started["io"].wait(10))
+
+            result = worker_app.send_task(
+                "core.tasks.record_checkout", args=([1],)
+            )
+            self.assertEqual(result.get(timeout=10), ["io", "sweeps"])
+        finally:
+            release.set()
+            for worker in reversed(workers):
+                worker.__exit__(None, None, None)
+        self.assertTrue(finished["sweeps"].is_set() and finished["io"].is_set())
+
+
+class ProxyRentsTest(TestCase):
+    def test_latest_rents_expiring_soon_are_notified_once(self):
+        today = timezone.localdate()
+        tomorrow = today + timedelta(days=1)
+        proxies = {
+            ip: Proxy.objects.create(ip=ip, port="8000")
+            for ip in ("10.0.2.1", "10.0.2.2", "10.0.2.3", "10.0.2.4")
+        }
+        ProxyRent.objects.create(proxy=proxies["10.0.2.1"], expiration_date=today)
+        ProxyRent.objects.create(proxy=proxies["10.0.2.2"], expiration_date=tomorrow)
+        # Renewed: only the latest rent counts
+        ProxyRent.objects.create(proxy=proxies["10.0.2.3"], expiration_date=today)
+        ProxyRent.objects.create(
+            proxy=proxies["10.0.2.3"], expiration_date=today + timedelta(days=30)
+        )
+        ProxyRent.objects.create(proxy=proxies["10.0.2.4"], expiration_date=today)
+        Proxy.objects.filter(ip="10.0.2.4").update(enable=False)
+
+        for _ in range(2):
+            tasks.check_proxy_rents()
+
+        self.assertEqual(
+            sorted(Notification.objects.values_list("kind", "subject")),
+            [
+                (Notification.Kind.RENT_EXPIRES_TODAY, "10.0.2.1"),
+                (Notification.Kind.RENT_EXPIRES_TOMORROW, "10.0.2.2"),
+            ],
+        )
+
+class SendNotificationsTest(TestCase):
+    def setUp(self):
+        self.telegram = standins.serve_in_thread(
+            standins.TelegramStandIn(("127.0.0.1", 0), fail_requests=[2])
+        )
+        self.addCleanup(self.telegram.server_close)
+        self.addCleanup(self.telegram.shutdown)
+        Notification.objects.bulk_create([
+            Notification(
+                kind=Notification.Kind.RENT_EXPIRES_TODAY,
+                subject=f"{i}:" + "x" * 200,
+            )
+            for i in range(50)
+        ])
+
+    def test_resumes_after_failed_message(self):
+        batches = notifications.split_digest(Notification.objects.order_by("id"))
+        self.assertGreater(len(batches), 2)
+
+        with override_settings(TELEGRAM_API_URL=self.telegram.url):
+            tasks.send_notifications()
+            self.assertEqual(len(self.telegram.messages), 1)
+            self.assertEqual(
+                Notification.objects.filter(sent__isnull=False).count(),
+                len(batches[0]),
+            )
+            self.assertEqual(
+                set(Notification.objects.filter(
+                    sent__isnull=True
+                ).values_list("attempts", flat=True)),
+                {1},
+            )
+
+            Notification.objects.update(next_attempt=timezone.now())
+            tasks.send_notifications()
+
+        # The first message is not delivered twice
+        self.assertEqual(len(self.telegram.messages), len(batches))
+        self.assertFalse(Notification.objects.filter(sent__isnull=True).exists())
+
+
+class ReleaseAccountTest(TestCase):
+    def setUp(self):
+        self.account = create_account(Network.objects.create(title="vk"), "1")
+        self.account.status = CredentialsProxy.Status.WAITING
+        self.account.save()
+        # The wait is over
+        CredentialsProxy.objects.filter(id=self.account.id).update(
+            waiting_since=self.account.waiting_since
+            - timedelta(seconds=self.account.waiting_delta),
+        )
+        self.account.refresh_from_db()
+        self.waiting_since = self.account.waiting_since.isoformat()
+
+    def test_release_survives_saves_that_keep_the_status(self):
+        account = CredentialsProxy.objects.get(id=self.account.id)
+        account.status_description = "cookies updated"
+        account.save()
+
+        tasks.release_account(self.account.id, self.waiting_since)
+        account.refresh_from_db()
+        self.assertEqual(account.status, CredentialsProxy.Status.AVAILABLE)
+
+    def test_stale_release_is_dropped(self):
+        for status in (
+            CredentialsProxy.Status.SENT, CredentialsProxy.Status.WAITING
+        ):
+            account = CredentialsProxy.objects.get(id=self.account.id)
+            account.status = status
+            account.save()
+
+        tasks.release_account(self.account.id, self.waiting_since)
+        account.refresh_from_db()
+        self.assertEqual(account.status, CredentialsProxy.Status.WAITING)
+
+
+    @mock.patch.object(amqp, "publish_delayed", return_value=64)
+    def test_early_release_waits_out_the_rest(self, publish_delayed):
+        CredentialsProxy.objects.filter(id=self.account.id).update(
+            waiting_delta=self.account.waiting_delta + 100,
+        )
+
+        tasks.release_account(self.account.id, self.waiting_since)
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.status, CredentialsProxy.Status.WAITING)
+        delay, body = publish_delayed.call_args.args
+        self.assertTrue(95 <= delay <= 100)
+        self.assertEqual(body["waiting_since"], self.waiting_since)
+
+    def test_delay_buckets(self):
+        self.assertEqual(
+            [amqp.get_delay_bucket(delay) for delay in (0, 1, 3, 60, 64, 3600)],
+            [1, 1, 2, 32, 64, 2048],
+        )
+
+    def test_fallback_sweep_leaves_pending_releases(self):
+        now = timezone.now()
+        overdue = create_account(self.account.credentials.network, "2")
+        CredentialsProxy.objects.filter(id=overdue.id).update(
+            status=CredentialsProxy.Status.WAITING,
+            waiting_since=now - timedelta(
+                seconds=overdue.waiting_delta + settings.RELEASE_GRACE + 60
+            ),
+        )
+        # Its wait is over, but the release message is not overdue yet
+        CredentialsProxy.objects.filter(id=self.account.id).update(
+            waiting_since=now - timedelta(seconds=self.account.waiting_delta + 60),
+        )
+
+        tasks.update_credentials_proxy_statuses()
+        self.assertEqual(
+            dict(CredentialsProxy.objects.values_list("id", "status")),
+            {
+                self.account.id: CredentialsProxy.Status.WAITING,
+                overdue.id: CredentialsProxy.Status.AVAILABLE,
+            },
+        )
+
+
+class RebalancerTest(TestCase):
+    def test_accounts_leave_dead_proxy_available(self):
+        network = Network.objects.create(title="vk")
+        dead = Proxy.objects.create(ip="10.0.0.1", port="8000", enable=False)
+        healthy = Proxy.objects.create(ip="10.0.0.2", port="8000")
+        account = create_account(network, "1", proxy=dead)
+        CredentialsProxy.objects.filter(id=account.id).update(
+            status=CredentialsProxy.Status.PROXY_ERROR
+        )
+
+        moves, unplaced, moved = rebalancer.rebalance()
+
+        self.assertEqual((len(moves), unplaced, moved), (1, 0, 1))
+        account.refresh_from_db()
+        self.assertEqual(account.proxy, healthy)
+        self.assertEqual(account.status, CredentialsProxy.Status.AVAILABLE)
+
+
+class ProxyCheckTest(TestCase):
+    def setUp(self):
+        # A proxy that accepts connections and answers the SOCKS5 greeting
+        self.server = socket.create_server(("127.0.0.1", 0))
+        self.addCleanup(self.stop)
+        self.proxy = Proxy.objects.create(
+            ip="127.0.0.1", port=str(self.server.getsockname()[1]),
+            type=Proxy.Type.SOCKS5,
+        )
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def stop(self):
+        # close() alone does not wake the accept() of the serving thread,
+        # the port would keep taking connections
+        if self.server.fileno() != -1:
+            self.server.shutdown(socket.SHUT_RDWR)
+            self.server.close()
+
+    def serve(self):
+        while True:
+            try:
+                connection, _ = self.server.accept()
+            except OSError:
+                return
+            with connection:
+                if connection.recv(3):
+                    connection.sendall(b"\x05\x00")
+
+    def check(self, method):
+        with override_settings(PROXY_CHECK_METHOD=method):
+            self.proxy.update_status()
+        return self.proxy.status, self.proxy.checks.latest("id").success
+
+    def test_reachable_proxy_passes_checks_without_exit_ip(self):
+        for method in ("tcp", "socks"):
+            # No exit ip is made up for the ip comparison
+            result_ip, connect_ms = utils.PROXY_CHECKS[method](self.proxy.url)
+            self.assertIsNone(result_ip)
+            self.assertGreaterEqual(connect_ms, 0)
+            self.assertEqual(
+                self.check(method), (Proxy.Status.AVAILABLE, True), method
+            )
+
+    @mock.patch.object(utils, "get_session")
+    def test_ip_echo_compares_the_exit_ip(self, get_session):
+        # The echo request is the only connection, none is made beside it
+        self.stop()
+        get_session.return_value.get.return_value.text = "10.0.0.1\n"
+        self.assertEqual(self.check("ip_echo"), (Proxy.Status.IP_NOT_EQUAL, False))
+
+        get_session.return_value.get.return_value.text = "127.0.0.1\n"
+        self.assertEqual(self.check("ip_echo"), (Proxy.Status.AVAILABLE, True))
+        self.assertEqual(
+            list(self.proxy.checks.values_list("connect_ms", flat=True)),
+            [None, None],
+        )
+
+    def test_unreachable_proxy_is_disabled(self):
+        self.stop()
+        self.assertEqual(self.check("tcp"), (Proxy.Status.NOT_AVAILABLE, False))
+        self.assertFalse(self.proxy.enable)
+
+class ProxyLatencyTest(TestCase):
+    def setUp(self):
+        self.proxies = {
+            name: Proxy.objects.create(ip=f"10.0.4.{i}", port="8000")
+            for i, name in enumerate(("fast", "slow", "flaky", "unchecked"))
+        }
+
+    def add_checks(self, name, *checks):
+        ProxyCheck.objects.bulk_create(
+            ProxyCheck(
+                proxy=self.proxies[name], success=success,
+                connect_ms=total_ms // 10, total_ms=total_ms,
+            )
+            for success, total_ms in checks
+        )
+
+    def test_summarize(self):
+        self.add_checks("fast", (True, 100), (True, 200), (True, 300))
+        self.add_checks("flaky", (True, 100), *[(False, 100)] * 3)
+        # Out of the window, dropped before summarizing
+        ProxyCheck.objects.create(
+            proxy=self.proxies["slow"], success=False, total_ms=100,
+            created=timezone.now() - timedelta(days=settings.PROXY_CHECK_WINDOW + 1),
+        )
+
+        self.assertEqual(ProxyCheck.summarize(), 2)
+        self.assertEqual(
+            {
+                proxy.ip: (
+                    proxy.connect_p50, proxy.latency_p50, proxy.latency_p95,
+                    proxy.success_rate,
+                )
+                for proxy in Proxy.objects.all()
+            },
+            {
+                "10.0.4.0": (20, 200, 290, 1.0),
+                "10.0.4.1": (None, None, None, None),
+                "10.0.4.2": (10, 100, 100, 0.25),
+                "10.0.4.3": (None, None, None, None),
+            },
+        )
+
+    def test_by_preference(self):
+        for name, latency_p95, success_rate in (
+            ("fast", 290, 1.0),
+            ("slow", 1950, 0.9),
+            ("flaky", 100, 0.25),
+            ("unchecked", None, None),
+        ):
+            Proxy.objects.filter(id=self.proxies[name].id).update(
+                latency_p95=latency_p95, success_rate=success_rate
+            )
+
+        # Reliable first, then fast, unchecked proxies after the measured
+        expected = ["10.0.4.0", "10.0.4.1", "10.0.4.3", "10.0.4.2"]
+        self.assertEqual(
+            list(Proxy.objects.by_preference().values_list("ip", flat=True)),
+            expected,
+        )
+        # The rebalancer orders its targets the same way in Python
+        self.assertEqual(
+            [
+                proxy.ip for proxy in sorted(
+                    Proxy.objects.order_by("id"), key=rebalancer.get_preference
+                )
+            ],
+            expected,
+        )
+
+@mock.patch.object(circuit.app, "send_task")
+class CircuitTest(TestCase):
+    def setUp(self):
+        network = Network.objects.create(title="vk")
+        self.parked = create_account(network, "1")
+        self.proxy = self.parked.proxy
+        self.used = create_account(network, "2", proxy=self.proxy)
+        CredentialsProxy.objects.filter(id=self.parked.id).update(
+            status=CredentialsProxy.Status.AVAILABLE
+        )
+
+    def record_failures(self, count):
+        for account in (self.parked, self.used)[:count]:
+            circuit.record_failure(self.proxy.id, account.id)
+        self.proxy.refresh_from_db()
+
+    def half_open(self):
+        with mock.patch.object(tasks.publish_account, "delay") as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assertTrue(circuit.half_open(self.proxy))
+        self.proxy.refresh_from_db()
+        return delay
+
+    @override_settings(CIRCUIT_THRESHOLD=2)
+    def test_trip_half_open_and_close(self, send_task):
+        self.record_failures(1)
+        self.assertEqual(self.proxy.circuit, Proxy.Circuit.CLOSED)
+        self.record_failures(2)
+        self.assertEqual(self.proxy.circuit, Proxy.Circuit.OPEN)
+        self.assertFalse(self.proxy.enable)
+        send_task.assert_called_once_with(
+            "recheck_proxy", args=(self.proxy.id,),
+            countdown=settings.CIRCUIT_RECHECK_DELAY,
+        )
+
+        # A ban reported after the trip keeps its own wait
+        self.used.status = CredentialsProxy.Status.WAITING
+        self.used.save()
+
+        delay = self.half_open()
+        delay.assert_called_once_with(self.parked.id)
+        self.assertEqual(self.proxy.circuit, Proxy.Circuit.HALF_OPEN)
+        self.assertTrue(self.proxy.enable)
+        self.assertEqual(
+            dict(CredentialsProxy.objects.values_list("id", "status")),
+            {
+                self.parked.id: CredentialsProxy.Status.AVAILABLE,
+                self.used.id: CredentialsProxy.Status.WAITING,
+            },
+        )
+
+        self.assertTrue(circuit.close(self.proxy.id, self.proxy.circuit_changed))
+        self.proxy.refresh_from_db()
+        self.assertEqual(self.proxy.circuit, Proxy.Circuit.CLOSED)
+
+    def test_failure_on_probation_opens_again(self, send_task):
+        Proxy.objects.filter(id=self.proxy.id).update(
+            circuit=Proxy.Circuit.HALF_OPEN, circuit_changed=timezone.now()
+        )
+        self.record_failures(1)
+        self.assertEqual(self.proxy.circuit, Proxy.Circuit.OPEN)
+        # close_circuit scheduled on half open finds the circuit open again
+        self.assertFalse(circuit.close(self.proxy.id, self.proxy.circuit_changed))
+
+    def test_disabled_proxy_stays_disabled(self, send_task):
+        Proxy.objects.filter(id=self.proxy.id).update(enable=False)
+        circuit.trip(self.proxy.id)
+        self.proxy.refresh_from_db()
+
+        self.half_open()
+        self.assertEqual(self.proxy.circuit, Proxy.Circuit.HALF_OPEN)
+        self.assertFalse(self.proxy.enable)
+
+class ReconcileTest(TestCase):
+    def setUp(self):
+        self.network = Network.objects.create(title="vk", priority_delivery=True)
+        self.now = timezone.now()
+
+    def queue_account(self, login, priority, age):
+        account = create_account(self.network, login)
+        CredentialsProxy.objects.filter(id=account.id).update(
+            status=CredentialsProxy.Status.IN_QUEUE,
+            published_at=self.now - timedelta(seconds=age),
+            published_priority=priority,
+        )
+        return account.id
+
+    def test_priority_queue_is_reconciled_against_its_head(self):
+        before_head = self.queue_account("1", 5, 600)
+        higher = self.queue_account("2", 9, 500)
+        head = self.queue_account("3", 5, 300)
+        lower = self.queue_account("4", 3, 900)
+        recent = self.queue_account("5", 9, 10)
+        headers = amqp.make_headers(
+            [head], self.now - timedelta(seconds=300), None, 5
+        )
+
+        def inspect_queue(queue):
+            if queue.name.endswith(".priority"):
+                return 3, headers
+            return 0, None
+
+        with mock.patch.object(amqp, "inspect_queue", inspect_queue):
+            self.assertEqual(reconcile.reconcile_network(self.network), 2)
+
+        self.assertQuerysetEqual(
+            CredentialsProxy.objects.filter(
+                status=CredentialsProxy.Status.AVAILABLE
+            ).values_list("id", flat=True),
+            [before_head, higher],
+            ordered=False,
+        )
+        self.assertEqual(
+            CredentialsProxy.objects.filter(
+                id__in=[head, lower, recent],
+                status=CredentialsProxy.Status.IN_QUEUE,
+            ).count(),
+            3,
+        )
+
+
+class AccountPayloadTest(TestCase):
+    def test_payload_matches_the_serializer(self):
+        static = Network.objects.create(title="tg")
+        dynamic = Network.objects.create(title="vk", dynamic_limits=True)
+        for network in (static, dynamic):
+            for title, limit in (("posts", 100), ("comments", 50)):
+                ParsingType.objects.create(
+                    network=network, title=title, code=title, limit=limit
+                )
+
+        accounts = [create_account(static, "1"), create_account(dynamic, "2")]
+        # Planned limits for every type, so no random dynamic limit is drawn
+        CredentialsLimits.objects.create(
+            credentials_proxy=accounts[1], limits={"posts": 30, "comments": 70}
+        )
+        CredentialsProxy.objects.update(
+            start_time_of_use=timezone.now(),
+            status_description="ошибка входа",
+            token="token",
+        )
+        Proxy.objects.filter(id=accounts[1].proxy_id).update(
+            mobile=True, latency_p50=120, latency_p95=300, success_rate=0.9
+        )
+
+        def load(account):
+            return CredentialsProxy.objects.select_related(
+                "credentials", "credentials__network", "proxy", "limit_plan"
+            ).get(id=account.id)
+
+        for account in accounts:
+            with self.subTest(network=account.credentials.network.title):
+                payload = make_account_payload(load(account), load_network_types())
+                self.assertEqual(
+                    payload, CredentialsProxySerializer(load(account)).data
+                )
+        self.assertEqual(payload["limits"], {"posts": 30, "comments": 50})
+
+class RendererTest(SimpleTestCase):
+    data = {
+        "id": 1,
+        "created": timezone.now(),
+        "date": timezone.localdate(),
+        "token": uuid.uuid4(),
+        "price": Decimal("1.50"),
+        "limits": {1: "posts"},
+        "login": "логин",
+    }
+
+    def test_output_matches_drf(self):
+        rendered = ORJSONRenderer().render(self.data)
+        self.assertEqual(
+            json.loads(rendered), json.loads(JSONRenderer().render(self.data))
+        )
+        self.assertIn(b"\n  ", ORJSONRenderer().render(
+            self.data, renderer_context={"indent": 2}
+        ))
+
+    def test_parser(self):
+        parser = ORJSONParser()
+        self.assertEqual(
+            parser.parse(io.BytesIO(b'{"status": "waiting", "cookies": null}')),
+            {"status": "waiting", "cookies": None},
+        )
+        with self.assertRaises(ParseError):
+            parser.parse(io.BytesIO(b"{"))
+
+
+class CompressionTest(TestCase):
+    def setUp(self):
+        network = Network.objects.create(title="vk")
+        for i in range(10):
+            create_account(network, str(i))
+
+    def get(self, url, encoding):
+        return self.client.get(url, HTTP_ACCEPT_ENCODING=encoding)
+
+    def test_api_responses_are_compressed(self):
+        plain = self.get("/api/proxy/", "")
+        self.assertFalse(plain.has_header("Content-Encoding"))
+        self.assertGreater(len(plain.content), 200)
+
+        response = self.get("/api/proxy/", "gzip, deflate, br")
+        self.assertEqual(response["Content-Encoding"], "br")
+        self.assertIn("Accept-Encoding", response["Vary"])
+        self.assertEqual(brotli.decompress(response.content), plain.content)
+
+        response = self.get("/api/proxy/", "gzip")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(response.content), plain.content)
+
+    def test_admin_pages_are_not_compressed(self):
+        self.client.force_login(
+            User.objects.create_superuser("admin", "admin@example.com", "admin")
+        )
+        response = self.get("/admin/", "gzip, br")
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header("Content-Encoding"))
+
+@override_settings(AMQP_URL="memory://")
+class MessageCodecTest(TestCase):
+    def setUp(self):
+        network = Network.objects.create(title="vk", dynamic_limits=True)
+        ParsingType.objects.create(network=network, title="посты", limit=100)
+        account = create_account(network, "1")
+        account.status_description = "ошибка входа"
+        account.save()
+        self.payload = make_account_payload(
+            CredentialsProxy.objects.select_related(
+                "credentials", "credentials__network", "proxy", "limit_plan"
+            ).get(id=account.id),
+            load_network_types(),
+        )
+
+    def consume_all(self, queue_name):
+        messages = []
+        while True:
+            message = amqp.consume_first([amqp.get_queue(queue_name)])
+            if message is None:
+                return messages
+            messages.append(message)
+
+    def test_round_trip(self):
+        for codec in amqp.CODECS:
+            with self.subTest(codec=codec):
+                amqp.publish(f"codec.{codec}", self.payload, codec=codec)
+                amqp.publish(f"codec.{codec}", [self.payload], codec=codec)
+                self.assertEqual(
+                    self.consume_all(f"codec.{codec}"),
+                    [self.payload, [self.payload]],
+                )
+
+    def test_mixed_codecs_in_one_queue(self):
+        for codec in amqp.CODECS:
+            amqp.publish("codec.mixed", self.payload, codec=codec)
+        self.assertEqual(
+            self.consume_all("codec.mixed"), [self.payload] * len(amqp.CODECS)
+        )
+
+
+@override_settings(AMQP_URL="memory://")
+class PriorityTest(TestCase):
+    def setUp(self):
+        self.network = Network.objects.create(title="tg", priority_delivery=True)
+        self.account = create_account(self.network, "1")
+
+    def get_priority(self):
+        return tasks.get_priority(
+            CredentialsProxy.objects.select_related(
+                "credentials__network"
+            ).with_health_penalty().get(id=self.account.id)
+        )
+
+    def test_priority_drops_with_recent_failures(self):
+        self.assertEqual(self.get_priority(), amqp.MAX_PRIORITY)
+
+        statistics = create_statistics(
+            self.account, CredentialsStatistics.Status.LOGIN_FAILED, None
+        )
+        self.assertEqual(self.get_priority(), amqp.MAX_PRIORITY - 2)
+
+        # Failures older than the health window are forgiven
+        CredentialsStatistics.objects.filter(id=statistics.id).update(
+            end_time_of_use=timezone.now()
+            - CredentialsStatistics.HEALTH_WINDOW - timedelta(minutes=1)
+        )
+        for _ in range(2):
+            create_statistics(
+                self.account, CredentialsStatistics.Status.BANNED, None
+            )
+        self.assertEqual(self.get_priority(), 0)
+
+        Network.objects.filter(id=self.network.id).update(
+            priority_delivery=False
+        )
+        self.assertIsNone(self.get_priority())
+
+    def test_priority_queue_is_declared_next_to_the_plain_one(self):
+        queue = amqp.get_queue("vk", priority=True, shard=1)
+        self.assertEqual(
+            (queue.name, queue.max_priority), ("vk.1.priority", amqp.MAX_PRIORITY)
+        )
+        queue = amqp.get_queue("vk", shard=1)
+        self.assertEqual((queue.name, queue.max_priority), ("vk.1", None))
+
+        CredentialsProxy.objects.filter(id=self.account.id).update(
+            status=CredentialsProxy.Status.AVAILABLE
+        )
+        tasks.publish_account(self.account.id)
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.published_priority, amqp.MAX_PRIORITY)
+        self.assertIsNone(amqp.consume_first([amqp.get_queue("tg")]))
+        self.assertEqual(
+            amqp.consume_first([amqp.get_queue("tg", priority=True)])["id"],
+            self.account.id,
+        )
+
+@override_settings(AMQP_URL="memory://")
+class OkBundleTest(TestCase):
+    def setUp(self):
+        ok = Network.objects.create(title="ok")
+        shared = Proxy.objects.create(ip="10.0.1.1", port="8000")
+        self.bundled = [
+            create_account(ok, "1", proxy=shared),
+            create_account(ok, "2", proxy=Proxy.objects.create(ip="10.0.1.1", port="8001")),
+        ]
+        self.alone = create_account(ok, "3")
+        self.sent = create_account(ok, "4", proxy=shared)
+        CredentialsProxy.objects.exclude(id=self.sent.id).update(
+            status=CredentialsProxy.Status.AVAILABLE
+        )
+
+    def test_accounts_of_one_ip_are_bundled(self):
+        with mock.patch.object(
+            QuerySet, "select_for_update", autospec=True,
+            side_effect=QuerySet.select_for_update,
+        ) as select_for_update:
+            tasks.load_ok_accounts_to_queue()
+        # Rows another run holds are skipped, not waited for
+        select_for_update.assert_called_once_with(
+            mock.ANY, skip_locked=True, of=("self",)
+        )
+
+        messages = []
+        while (message := amqp.consume_first([amqp.get_queue("ok")])) is not None:
+            messages.append(sorted(account["id"] for account in message))
+        self.assertEqual(
+            sorted(messages),
+            [[account.id for account in self.bundled], [self.alone.id]],
+        )
+
+        accounts = CredentialsProxy.objects.order_by("id")
+        self.assertEqual(
+            [account.status for account in accounts],
+            [CredentialsProxy.Status.IN_QUEUE] * 3 + [CredentialsProxy.Status.SENT],
+        )
+        # One token for the whole run
+        self.assertEqual(
+            len({account.publish_token for account in accounts[:3]}), 1
+        )
+
+@override_settings(AMQP_URL="memory://")
+@mock.patch.object(tasks.record_checkout, "delay")
+class ShardTest(TestCase):
+    def test_shard_keys(self, record_checkout):
+        self.assertIsNone(amqp.get_shard(5, 1))
+        self.assertEqual(amqp.get_shard(5, 4), 1)
+        # ok is sharded by proxy ip, the same ip always maps to one shard
+        shard = amqp.get_shard("10.0.0.1", 4)
+        self.assertIn(shard, range(4))
+        self.assertEqual(amqp.get_shard("10.0.0.1", 4), shard)
+
+    def test_checkouts_rotate_over_shards(self, record_checkout):
+        self.assertEqual(
+            [queue.name for queue in amqp.get_checkout_queues("vk")], ["vk"]
+        )
+        orders = [
+            [queue.name for queue in amqp.get_checkout_queues("vk", 3, True)]
+            for _ in range(3)
+        ]
+        # Every shard, its priority queue first, from a new shard each time
+        for names in orders:
+            self.assertEqual(sorted(names), sorted(
+                f"vk.{shard}{suffix}" for shard in range(3)
+                for suffix in ("", ".priority")
+            ))
+            self.assertTrue(names[0].endswith(".priority"))
+        self.assertEqual(len({names[0] for names in orders}), 3)
+
+    def test_accounts_are_published_to_their_shard(self, record_checkout):
+        network = Network.objects.create(title="sharded", queue_shards=3)
+        accounts = [create_account(network, str(i)) for i in range(1, 4)]
+        CredentialsProxy.objects.update(status=CredentialsProxy.Status.AVAILABLE)
+        tasks.load_accounts_to_queue()
+
+        for account in accounts:
+            queue = amqp.get_queue("sharded", shard=account.proxy_id % 3)
+            self.assertEqual(amqp.consume_first([queue])["id"], account.id)
+
+        # Checkouts read every shard
+        CredentialsProxy.objects.update(status=CredentialsProxy.Status.AVAILABLE)
+        tasks.load_accounts_to_queue()
+        checked_out = {
+            self.client.get("/api/credentials/sharded").json()["id"]
+            for _ in accounts
+        }
+        self.assertEqual(checked_out, {account.id for account in accounts})
+        self.assertEqual(
+            self.client.get("/api/credentials/sharded").status_code, 404
+        )
+
+@override_settings(AMQP_URL="memory://")
+class LoadAccountsTest(TestCase):
+    def setUp(self):
+        self.network = Network.objects.create(title="capped")
+        self.proxies = {
+            name: Proxy.objects.create(ip=f"10.0.3.{i}", port="8000", mobile=mobile)
+            for i, (name, mobile) in enumerate(
+                (("a", True), ("b", False), ("c", True))
+            )
+        }
+        self.accounts = {
+            name: [
+                create_account(self.network, f"{name}{i}", proxy=proxy)
+                for i in range(count)
+            ]
+            for (name, proxy), count in zip(self.proxies.items(), (3, 2, 1))
+        }
+
+    def test_consecutive_accounts_use_different_proxies(self):
+        ordered = tasks.interleave_by_proxy(
+            CredentialsProxy.objects.select_related(
+                "credentials", "proxy"
+            ).order_by("id")
+        )
+        # Mobile and regular proxies alternate while both have accounts
+        self.assertEqual(
+            [account.proxy.ip for account in ordered],
+            ["10.0.3.0", "10.0.3.1", "10.0.3.2", "10.0.3.0", "10.0.3.1", "10.0.3.0"],
+        )
+
+    def test_accounts_in_flight_are_capped_per_proxy(self):
+        Network.objects.filter(id=self.network.id).update(max_accounts_per_proxy=2)
+        # One account of proxy a is out with a parser already
+        CredentialsProxy.objects.exclude(
+            id=self.accounts["a"][0].id
+        ).update(status=CredentialsProxy.Status.AVAILABLE)
+
+        tasks.load_accounts_to_queue()
+        self.assertEqual(
+            dict(CredentialsProxy.objects.filter(
+                status__in=CredentialsProxy.IN_FLIGHT_STATUSES
+            ).values_list("proxy__ip").annotate(count=Count("id"))),
+            {"10.0.3.0": 2, "10.0.3.1": 2, "10.0.3.2": 1},
+        )
+
+        # The claim itself keeps the cap for single publishes as well
+        left = CredentialsProxy.objects.get(
+            proxy=self.proxies["a"], status=CredentialsProxy.Status.AVAILABLE
+        )
+        tasks.publish_account(left.id)
+        left.refresh_from_db()
+        self.assertEqual(left.status, CredentialsProxy.Status.AVAILABLE)
+
+class SkipIfRunningTest(TestCase):
+    def setUp(self):
+        self.calls = []
+
+        @locks.skip_if_running
+        def sweep(value):
+            self.calls.append(value)
+            return value
+
+        self.sweep = sweep
+
+    def test_runs_when_free(self):
+        self.assertEqual(self.sweep(1), 1)
+        self.assertEqual(self.calls, [1])
+        self.assertFalse(Metric.objects.exists())
+
+    def test_skips_when_running(self):
+        @contextmanager
+        def held(name):
+            self.assertEqual(name, "task:sweep")
+            yield False
+
+        with mock.patch.object(locks, "advisory_lock", held):
+            self.assertIsNone(self.sweep(1))
+            self.assertIsNone(self.sweep(2))
+
+        self.assertEqual(self.calls, [])
+        self.assertEqual(
+            Metric.objects.get(name="skipped_sweep").value, 2
+        )
+
+    @skipUnless(connection.vendor == "postgresql", "advisory locks")
+    def test_lock_held_by_another_session(self):
+        key = locks.get_lock_key("task:sweep")
+        other = connections.create_connection("default")
+        try:
+            with other.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_lock(%s)", [key])
+            self.assertIsNone(self.sweep(1))
+
+            with other.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_unlock(%s)", [key])
+            self.assertEqual(self.sweep(2), 2)
+        finally:
+            other.close()
+
+        self.assertEqual(self.calls, [2])
+        # Released after the run, the next one takes it again
+        with locks.advisory_lock("task:sweep") as acquired:
+            self.assertTrue(acquired)
+
+@override_settings(AMQP_URL="memory://")
+@mock.patch.object(tasks.record_checkout, "delay")
+class CheckoutTest(TestCase):
+    def setUp(self):
+        self.account = create_account(Network.objects.create(title="vk"), "1")
+
+    def publish(self):
+        CredentialsProxy.objects.filter(id=self.account.id).update(
+            status=CredentialsProxy.Status.AVAILABLE
+        )
+        tasks.publish_account(self.account.id)
+
+    def test_stale_duplicate_is_dropped(self, record_checkout):
+        self.publish()
+        # Reset and published again while the first message is still queued
+        self.publish()
+
+        response = self.client.get("/api/credentials/vk")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["id"], self.account.id)
+        self.assertEqual(self.client.get("/api/credentials/vk").status_code, 404)
+
+        record_checkout.assert_called_once_with([self.account.id])
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.status, CredentialsProxy.Status.SENT)
+        self.assertEqual(
+            Metric.objects.get(name="checkout_duplicates_dropped").value, 1
+        )
+
+    def test_record_checkout_keeps_reported_status(self, record_checkout):
+        self.publish()
+        self.client.get("/api/credentials/vk")
+        # The worker reports before the counters task runs
+        CredentialsProxy.objects.filter(id=self.account.id).update(
+            status=CredentialsProxy.Status.WAITING
+        )
+
+        tasks.record_checkout(*record_checkout.call_args.args)
+
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.status, CredentialsProxy.Status.WAITING)
+        self.assertEqual(self.account.counter, 1)
+        self.assertEqual(
+            ProxyCounter.objects.get(proxy=self.account.proxy).counter, 1
+        )
+
+
+    def test_lease_is_reclaimed_only_after_it_expires(self, record_checkout):
+        self.publish()
+        self.client.get("/api/credentials/vk")
+
+        # A worker that never extends the lease keeps the account for a
+        # whole session
+        tasks.reclaim_expired_leases()
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.status, CredentialsProxy.Status.SENT)
+        self.assertGreater(
+            self.account.lease_expires_at,
+            timezone.now() + timedelta(seconds=settings.CREDENTIALS_LEASE),
+        )
+
+        response = self.client.post(f"/api/credentials/{self.account.id}/lease")
+        self.assertEqual(response.status_code, 200)
+        CredentialsProxy.objects.filter(id=self.account.id).update(
+            lease_expires_at=timezone.now() - timedelta(seconds=1)
+        )
+
+        tasks.reclaim_expired_leases()
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.status, CredentialsProxy.Status.AVAILABLE)
+        self.assertIsNone(self.account.lease_expires_at)
+        self.assertEqual(
+            Metric.objects.get(name="reclaimed_leases_sent").value, 1
+        )
+
+@override_settings(AMQP_URL="memory://")
+@mock.patch.object(tasks.record_checkout, "delay")
+class CookiesTest(TestCase):
+    cookies = [{"name": "sid", "value": "1", "domain": ".vk.com"}]
+
+    def setUp(self):
+        self.account = create_account(Network.objects.create(title="vk"), "1")
+
+    def report(self, cookies):
+        response = self.client.patch(
+            f"/api/credentials/{self.account.id}",
+            {"cookies": cookies},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def test_cookies_come_back_at_checkout(self, record_checkout):
+        # String-encoded jars from older workers are stored decoded
+        self.report(json.dumps(self.cookies))
+        CredentialsProxy.objects.filter(id=self.account.id).update(
+            status=CredentialsProxy.Status.AVAILABLE
+        )
+        tasks.publish_account(self.account.id)
+
+        response = self.client.get("/api/credentials/vk")
+        self.assertEqual(response.json()["cookies"], self.cookies)
+        self.assertEqual(
+            self.client.get(
+                "/api/credentials/", {"id": self.account.id}
+            ).json()[0]["cookies"],
+            self.cookies,
+        )
+
+        self.report(None)
+        self.assertFalse(CredentialsCookies.objects.exists())
+
+    def test_unchanged_jar_is_not_written(self, record_checkout):
+        jar = {"b": [1, 2], "a": {"y": 1, "x": 2}}
+        self.assertTrue(CredentialsCookies.store(self.account.id, jar))
+        stored = CredentialsCookies.objects.get()
+
+        # Same jar, keys in another order
+        reordered = {"a": {"x": 2, "y": 1}, "b": [1, 2]}
+        self.assertFalse(CredentialsCookies.store(self.account.id, reordered))
+        self.assertEqual(CredentialsCookies.objects.get().updated, stored.updated)
+
+        self.assertTrue(CredentialsCookies.store(self.account.id, {"b": [2, 1]}))
+        self.assertEqual(
+            CredentialsCookies.load([self.account.id]),
+            {self.account.id: {"b": [2, 1]}},
+        )
+        self.assertTrue(CredentialsCookies.store(self.account.id, None))
+        self.assertFalse(CredentialsCookies.store(self.account.id, None))
+
+class StatisticsApiTest(TestCase):
+    def setUp(self):
+        network = Network.objects.create(title="vk")
+        ParsingType.objects.create(network=network, title="posts", limit=10)
+        self.account = create_account(network, "1")
+        self.account.start_time_of_use = timezone.now()
+        self.account.save()
+
+    def test_statistics_are_not_kept_without_requests(self):
+        with mock.patch.object(
+            CredentialsStatisticsRequest.objects,
+            "bulk_create",
+            side_effect=DatabaseError,
+        ):
+            with self.assertRaises(DatabaseError):
+                self.client.post(
+                    "/api/statistics/",
+                    {
+                        "credentials_proxy": self.account.id,
+                        "request_count": {"posts": 5},
+                        "result_status": CredentialsStatistics.Status.BANNED,
+                    },
+                    content_type="application/json",
+                )
+        self.assertFalse(CredentialsStatistics.objects.exists())
+
+    def test_usage_rejects_malformed_dates(self):
+        for query in ("date_from=yesterday", "date_to=2024-13-40"):
+            with self.subTest(query=query):
+                response = self.client.get(f"/api/statistics/usage/vk?{query}")
+                self.assertEqual(response.status_code, 400)
+
+        response = self.client.get(
+            "/api/statistics/usage/vk?date_from=2024-01-01&date_to=2024-01-31"
+        )
+        self.assertEqual(response.status_code, 200)
+
+
+class PublishOnAvailableTest(TestCase):
+    def test_ok_accounts_are_left_to_the_bundle_loader(self):
+        vk = create_account(Network.objects.create(title="vk"), "1")
+        ok = create_account(Network.objects.create(title="ok"), "2")
+
+        with mock.patch.object(tasks.publish_account, "delay") as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                for account in (vk, ok):
+                    account.status = CredentialsProxy.Status.AVAILABLE
+                    account.save()
+
+        delay.assert_called_once_with(vk.id)
+
+    def test_bulk_releases_are_published(self):
+        network = Network.objects.create(title="vk")
+        reclaimed, reset = (
+            create_account(network, login) for login in ("1", "2")
+        )
+        CredentialsProxy.objects.filter(id=reclaimed.id).update(
+            lease_expires_at=timezone.now() - timedelta(seconds=1)
+        )
+        User.objects.create_superuser("admin", "admin@localhost", "admin")
+        self.client.login(username="admin", password="admin")
+
+        with mock.patch.object(tasks.publish_account, "delay") as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                tasks.reclaim_expired_leases()
+            delay.assert_called_once_with(reclaimed.id)
+
+            delay.reset_mock()
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post("/admin/core/credentialsproxy/", {
+                    "action": "make_available",
+                    "_selected_action": [reset.id],
+                })
+            delay.assert_called_once_with(reset.id)
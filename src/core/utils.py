@@ -1,17 +1,109 @@
 import logging
+import socket
+import struct
+import threading
+import time
+from urllib.parse import unquote, urlsplit
 
+from django.conf import settings
 import requests
 
 logger = logging.getLogger(__name__)
 
+local = threading.local()
 
-def check_proxy(proxy_url):
-    response = requests.get("https://api.ipify.org/", proxies={
-        "http": proxy_url,
-        "https": proxy_url,
-    })
+
+def get_session():
+    # One pooled session per thread, requests.Session is not thread safe
+    if not hasattr(local, "session"):
+        local.session = requests.Session()
+    return local.session
+
+
+def split_proxy_url(proxy_url):
+    url = urlsplit(proxy_url)
+    # Proxy.url renders missing credentials as "None"
+    login = unquote(url.username) if url.username not in (None, "None") else None
+    password = unquote(url.password) if url.password not in (None, "None") else None
+    return url.scheme, url.hostname, url.port, login, password
+
+
+# A check returns the exit ip it saw, if any, and the time it took to
+# connect to the proxy in milliseconds, if it knows it
+
+
+def connect(host, port):
+    started = time.perf_counter()
+    connection = socket.create_connection(
+        (host, port), timeout=settings.PROXY_CHECK_CONNECT_TIMEOUT
+    )
+    return connection, int((time.perf_counter() - started) * 1000)
+
+
+def check_ip_echo(proxy_url):
+    response = get_session().get(
+        settings.PROXY_CHECK_URL,
+        proxies={"http": proxy_url, "https": proxy_url},
+        timeout=(settings.PROXY_CHECK_CONNECT_TIMEOUT, settings.PROXY_CHECK_TIMEOUT),
+    )
     response.raise_for_status()
-    return response.text
+    # The connection to the proxy is made and pooled inside requests
+    return response.text.strip(), None
+
+
+def check_tcp(proxy_url):
+    _, host, port, _, _ = split_proxy_url(proxy_url)
+    connection, connect_ms = connect(host, port)
+    connection.close()
+    # Only reachability is known, not the exit ip
+    return None, connect_ms
+
+
+def check_socks(proxy_url):
+    scheme, host, port, login, password = split_proxy_url(proxy_url)
+    if not scheme.startswith("socks"):
+        return check_tcp(proxy_url)
+
+    connection, connect_ms = connect(host, port)
+    with connection:
+        connection.settimeout(settings.PROXY_CHECK_TIMEOUT)
+        method = b"\x02" if login else b"\x00"
+        connection.sendall(b"\x05\x01" + method)
+        version, chosen = struct.unpack("BB", receive(connection, 2))
+        if version != 5 or chosen != method[0]:
+            raise ConnectionError(f"SOCKS handshake refused: {version} {chosen}")
+
+        if login:
+            login, password = login.encode(), (password or "").encode()
+            connection.sendall(
+                b"\x01" + bytes([len(login)]) + login
+                + bytes([len(password)]) + password
+            )
+            _, status = struct.unpack("BB", receive(connection, 2))
+            if status != 0:
+                raise ConnectionError("SOCKS authentication failed")
+    return None, connect_ms
+
+
+def receive(connection, size):
+    data = b""
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        data += chunk
+    return data
+
+
+PROXY_CHECKS = {
+    "ip_echo": check_ip_echo,
+    "tcp": check_tcp,
+    "socks": check_socks,
+}
+
+
+def check_proxy(proxy_url):
+    return PROXY_CHECKS[settings.PROXY_CHECK_METHOD](proxy_url)
 
 
 def get_client_ip(request):
@@ -1,21 +1,38 @@
+from datetime import timedelta
+
+from django.conf import settings
 from django.db.models import Count, Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date
 from django_filters import rest_framework as filters
 from loguru import logger
 from rest_framework import generics
-from rest_framework.exceptions import NotFound
+from rest_framework.exceptions import NotFound, ValidationError
 from rest_framework.permissions import AllowAny
 from rest_framework.response import Response
 
-from core import amqp, tasks
+from core import amqp, circuit, metrics, tasks
 from core.filters import CredentialsFilter
 from core.models import (
-    CredentialsProxy, CredentialsStatistics, ParsingType, Proxy
+    CredentialsProxy,
+    CredentialsStatistics,
+    CredentialsStatisticsRequest,
+    Metric,
+    Network,
+    ParsingType,
+    Proxy,
 )
 from core.serializers import (
+    CredentialsProxyLeaseSerializer,
     CredentialsProxySerializer,
     CredentialsStatisticsSerializer,
+    MetricSerializer,
     ParsingTypeSerializer,
     ProxySerializer,
+    StatisticsUsageSerializer,
+    attach_cookies,
+    load_network_types,
+    make_account_payload,
 )
 from core.utils import get_client_ip
 
@@ -29,7 +46,15 @@ class CredentialsProxyView(generics.RetrieveAPIView):
             f"ip: {get_client_ip(request)} - RECEIVE REQUEST FOR {self.kwargs['network'].upper()}"
         )
 
-        credentials_proxy = amqp.consume(self.kwargs["network"])
+        priority_delivery, queue_shards = Network.objects.filter(
+            title=self.kwargs["network"]
+        ).values_list(
+            "priority_delivery", "queue_shards"
+        ).first() or (False, 1)
+
+        credentials_proxy = amqp.consume_first(amqp.get_checkout_queues(
+            self.kwargs["network"], queue_shards, priority_delivery
+        ), check=self.check_message)
 
         if not credentials_proxy:
             raise NotFound(
@@ -37,32 +62,91 @@ class CredentialsProxyView(generics.RetrieveAPIView):
                 code=404,
             )
 
+        accounts = (
+            credentials_proxy if isinstance(credentials_proxy, list)
+            else [credentials_proxy]
+        )
+        attach_cookies(accounts)
+        for credentials in accounts:
+            logger.info(f"cred: {credentials['id']} - RECEIVE FROM QUEUE")
+        tasks.record_checkout.delay(
+            [credentials["id"] for credentials in accounts]
+        )
+
         if isinstance(credentials_proxy, list):
-            for credentials in credentials_proxy:
-                logger.info(f"cred: {credentials['id']} - RECEIVE FROM QUEUE")
-                tasks.update_account_status.delay(
-                    credentials["id"], CredentialsProxy.Status.SENT
-                )
             credentials_proxy = {"accounts": credentials_proxy}
-        else:
-            logger.info(f"cred: {credentials_proxy['id']} - RECEIVE FROM QUEUE")
-            tasks.update_account_status.delay(
-                credentials_proxy["id"], CredentialsProxy.Status.SENT
+        return Response(credentials_proxy)
+
+    @staticmethod
+    def check_message(headers, payload):
+        # Messages published before the headers carry no token: their
+        # accounts have none either and are claimed the same way
+        account_ids = headers.get("account_ids") or [
+            credentials["id"] for credentials in (
+                payload if isinstance(payload, list) else [payload]
             )
+        ]
+        claimed = set(tasks.checkout_accounts(
+            account_ids, headers.get("publish_token")
+        ))
+        dropped = [
+            account_id for account_id in account_ids
+            if account_id not in claimed
+        ]
+        for account_id in dropped:
+            logger.info(f"cred: {account_id} - DUPLICATE MESSAGE DROPPED")
+        metrics.incr("checkout_duplicates_dropped", len(dropped))
 
-        return Response(credentials_proxy)
+        if isinstance(payload, list):
+            payload = [
+                credentials for credentials in payload
+                if credentials["id"] in claimed
+            ]
+            return payload or None
+        return payload if claimed else None
 
 
 class CredentialsProxyUpdateView(generics.UpdateAPIView):
     serializer_class = CredentialsProxySerializer
     permission_classes = [AllowAny]
 
-    queryset = CredentialsProxy.objects.all()
+    queryset = CredentialsProxy.objects.select_related("credentials__network")
     lookup_field = "pk"
 
+    def perform_update(self, serializer):
+        instance = serializer.save()
+        if instance.status == CredentialsProxy.Status.PROXY_ERROR:
+            circuit.record_failure(instance.proxy_id, instance.id)
+
+
+class CredentialsProxyLeaseView(generics.GenericAPIView):
+    serializer_class = CredentialsProxyLeaseSerializer
+    permission_classes = [AllowAny]
+
+    def post(self, request, *args, **kwargs):
+        extended = CredentialsProxy.objects.filter(
+            pk=self.kwargs["pk"], status=CredentialsProxy.Status.SENT
+        ).update(
+            lease_expires_at=timezone.now() + timedelta(
+                seconds=settings.CREDENTIALS_LEASE
+            )
+        )
+        if not extended:
+            raise NotFound(
+                detail="Аккаунт не выдан, продлить аренду нельзя",
+                code=404,
+            )
+
+        logger.info(f"cred: {self.kwargs['pk']} - LEASE EXTENDED")
+        return Response(self.serializer_class(
+            CredentialsProxy.objects.get(pk=self.kwargs["pk"])
+        ).data)
+
 
 class CredentialsProxyListView(generics.ListAPIView):
-    queryset = CredentialsProxy.objects.all()
+    queryset = CredentialsProxy.objects.select_related(
+        "credentials", "credentials__network", "proxy", "limit_plan"
+    )
 
     serializer_class = CredentialsProxySerializer
     permission_classes = [AllowAny]
@@ -70,6 +154,14 @@ class CredentialsProxyListView(generics.ListAPIView):
     filter_backends = [filters.DjangoFilterBackend]
     filterset_class = CredentialsFilter
 
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        network_types = load_network_types()
+        return Response(attach_cookies([
+            make_account_payload(credentials_proxy, network_types)
+            for credentials_proxy in queryset
+        ]))
+
 
 class ProxyListView(generics.ListAPIView):
     serializer_class = ProxySerializer
@@ -80,7 +172,7 @@ class ProxyListView(generics.ListAPIView):
             enable=True, status=Proxy.Status.AVAILABLE
         ).annotate(
             related_accounts_count=Count("credentials_proxy")
-        ).order_by("related_accounts_count")
+        ).by_preference("related_accounts_count")
 
 
 class ProxyView(generics.RetrieveAPIView):
@@ -96,7 +188,7 @@ class ProxyView(generics.RetrieveAPIView):
                     credentials_proxy__credentials__network__title=self.kwargs['network']
                 )
             )
-        ).order_by("related_accounts_count").first()
+        ).by_preference("related_accounts_count").first()
 
         return Response(self.serializer_class(obj).data)
 
@@ -107,6 +199,13 @@ class CredentialsStatisticsListView(generics.CreateAPIView):
 
     queryset = CredentialsStatistics.objects.all()
 
+    def perform_create(self, serializer):
+        instance = serializer.save()
+        if instance.result_status == CredentialsStatistics.Status.PROXY_ERROR:
+            circuit.record_failure(
+                instance.proxy_id, instance.credentials_proxy_id
+            )
+
 
 class LimitsView(generics.ListAPIView):
     serializer_class = ParsingTypeSerializer
@@ -114,3 +213,50 @@ class LimitsView(generics.ListAPIView):
 
     def get_queryset(self):
         return ParsingType.objects.filter(network__title=self.kwargs["network"])
+
+
+class MetricListView(generics.ListAPIView):
+    serializer_class = MetricSerializer
+    permission_classes = [AllowAny]
+
+    def get_queryset(self):
+        queryset = Metric.objects.order_by("-period")
+        if self.request.query_params.get("name"):
+            queryset = queryset.filter(name=self.request.query_params["name"])
+        return queryset
+
+
+class StatisticsUsageView(generics.ListAPIView):
+    serializer_class = StatisticsUsageSerializer
+    permission_classes = [AllowAny]
+
+    def get_queryset(self):
+        params = self.request.query_params
+        queryset = CredentialsStatisticsRequest.objects.filter(
+            parsing_type__network__title=self.kwargs["network"]
+        )
+        date_from = self.get_date("date_from")
+        if date_from:
+            queryset = queryset.filter(
+                statistics__end_time_of_use__date__gte=date_from
+            )
+        date_to = self.get_date("date_to")
+        if date_to:
+            queryset = queryset.filter(
+                statistics__end_time_of_use__date__lte=date_to
+            )
+        return queryset.usage(by_day=params.get("by_day") == "true")
+
+    def get_date(self, param):
+        value = self.request.query_params.get(param)
+        if not value:
+            return None
+        try:
+            date = parse_date(value)
+        except ValueError:
+            date = None
+        if date is None:
+            raise ValidationError(
+                {param: "Неверная дата, ожидается формат ГГГГ-ММ-ДД"}
+            )
+        return date